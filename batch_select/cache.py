@@ -0,0 +1,139 @@
+'''
+Caching of batch selected related objects between requests, using Django's
+cache framework.
+
+The related objects for each instance are cached under a key made from the
+relation, the database, the batch (its filters etc) and the instance's pk.  Each model
+also has a "generation" in the cache, which is changed (by any process) whenever
+an instance of it is saved or deleted, or links are added to/removed from a
+through model, and the generations of all the models a relation depends on are
+part of every key - which invalidates everything cached for that relation.
+'''
+from hashlib import md5
+from uuid import uuid4
+
+from django.conf import settings
+from django.core.cache import get_cache, DEFAULT_CACHE_ALIAS
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models.signals import post_save, post_delete, m2m_changed
+
+from signals import batch_m2m_changed
+
+# types that can be safely (and repeatably) turned into part of a cache key
+_KEY_TYPES = (basestring, int, long, float, bool, type(None))
+
+def _key_value(value):
+    # make sure the repr of value doesn't depend on anything but its contents
+    if isinstance(value, _KEY_TYPES):
+        return value
+    if isinstance(value, (list, tuple)):
+        return tuple(_key_value(v) for v in value)
+    if isinstance(value, dict):
+        return tuple(sorted((k, _key_value(v)) for k, v in value.items()))
+    raise ValueError('Cannot cache a batch using %r, only batches using plain '
+                     'values (strings, numbers etc) can be cached' % (value,))
+
+def batch_signature(replays, options):
+    '''
+    a string identifying the related objects selected by a batch
+    with the given replays and batch_select options
+    '''
+    signature = repr((_key_value(replays), _key_value(options)))
+    return md5(signature).hexdigest()
+
+def _relation_key(relation):
+    opts = relation.model._meta
+    return '%s.%s.%s' % (opts.app_label, opts.object_name.lower(),
+                         relation.fieldname)
+
+def _model_key(model):
+    opts = model._meta
+    return 'batch_select:%s.%s' % (opts.app_label, opts.object_name.lower())
+
+def _relation_models(relation):
+    # the models whose changes can change what relation selects
+    models = [relation.related_model]
+    if relation.through is not None:
+        models.append(relation.through)
+    if relation.forward:
+        # the objects being batch selected point at the related objects
+        models.append(relation.model)
+    return models
+
+class BatchCache(object):
+    '''
+    keeps track of the cached relations, and counts cache hits and misses
+    '''
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        # cache backends keyed by alias, as get_cache() creates a new one
+        # (and so a new connection, for memcached etc) every time
+        self._caches = {}
+
+    @property
+    def cache(self):
+        alias = getattr(settings, 'BATCH_SELECT_CACHE', DEFAULT_CACHE_ALIAS)
+        cache = self._caches.get(alias)
+        if cache is None:
+            cache = self._caches[alias] = get_cache(alias)
+        return cache
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+    def _generations(self, models):
+        keys = [_model_key(model) for model in models]
+        generations = self.cache.get_many(keys)
+        for key in keys:
+            if key not in generations:
+                self.cache.add(key, uuid4().hex, None)
+                generations[key] = self.cache.get(key)
+        return ':'.join('%s' % generations[key] for key in keys)
+
+    def prefix(self, relation, signature, using=DEFAULT_DB_ALIAS):
+        '''
+        the prefix for the cache keys of the related objects selected by a
+        batch from the database using, fetched once and used for both
+        getting and setting them, so that any changes made in between
+        invalidate what is set
+        '''
+        generations = self._generations(_relation_models(relation))
+        return 'batch_select:%s:%s:%s:%s' % (_relation_key(relation),
+                                             generations, using, signature)
+
+    def get_many(self, prefix, ids):
+        '''
+        returns a dict of the cached related objects for ids
+        '''
+        keys = dict(('%s:%s' % (prefix, id), id) for id in ids)
+        cached = self.cache.get_many(list(keys))
+        self.hits += len(cached)
+        self.misses += len(keys) - len(cached)
+        return dict((keys[key], value) for key, value in cached.items())
+
+    def set_many(self, prefix, grouped, timeout):
+        self.cache.set_many(dict(('%s:%s' % (prefix, id), value)
+                                 for id, value in grouped.items()),
+                            timeout)
+
+    def invalidate(self, model):
+        '''
+        invalidates anything cached for relations involving model
+        '''
+        self.cache.set(_model_key(model), uuid4().hex, None)
+
+batch_cache = BatchCache()
+
+def _changed(sender, **kwargs):
+    if kwargs.get('action', 'post_').startswith('post_'):
+        batch_cache.invalidate(sender)
+
+# connected for every sender (rather than when a relation is first cached), so
+# that changes made by any process invalidate what other processes cached
+post_save.connect(_changed, dispatch_uid='batch_select.cache')
+post_delete.connect(_changed, dispatch_uid='batch_select.cache')
+m2m_changed.connect(_changed, dispatch_uid='batch_select.cache')
+batch_m2m_changed.connect(_changed, dispatch_uid='batch_select.cache')
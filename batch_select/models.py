@@ -1,20 +1,69 @@
+import re
+from functools import partial
+from itertools import islice, groupby
+from operator import itemgetter
+from multiprocessing.pool import ThreadPool
+from time import time
+
 from django.db.models.query import QuerySet
-from django.db import models, connection
+from django.db.models.sql import Query
+from django.db.models.sql.query import get_order_dir
+from django.db.models.sql.constants import GET_ITERATOR_CHUNK_SIZE
+from django.db.models.base import ModelState
+from django.db.models.constants import LOOKUP_SEP
+from django.db import models, connections, router, transaction, DEFAULT_DB_ALIAS
+from django.db.models import Count
+from django.db.models.aggregates import Aggregate
 from django.db.models.fields import FieldDoesNotExist
-from django.contrib.contenttypes.generic import GenericRelation
+from django.db.models.sql.datastructures import EmptyResultSet
+from django.db.models.signals import class_prepared, pre_init, post_init, \
+                                     m2m_changed
+from django.utils.tree import Node
+from django.contrib.contenttypes.generic import GenericRelation, GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
 
 from django.conf import settings
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
 
 from replay import Replay
+from cache import batch_cache, batch_signature
+from signals import batch_executed, batch_m2m_changed
+
+# maximum number of parent ids sent in the IN clause of a single
+# related query.  sqlite is limited to 999 parameters by default (some
+# are left over for any filters), oracle to 1000 items in a list.
+# other backends can take more, but very long IN lists tend to get poor
+# query plans.
+DEFAULT_CHUNK_SIZES = {
+    'sqlite': 900,
+    'oracle': 1000,
+}
+DEFAULT_CHUNK_SIZE = 5000
+
+# maximum number of threads used by BatchQuerySet.batch_concurrently()
+DEFAULT_POOL_SIZE = 4
 
 def _not_exists(fieldname):
-    raise FieldDoesNotExist('"%s" is not a ManyToManyField or a reverse ForeignKey relationship' % fieldname)
+    raise FieldDoesNotExist('"%s" is not a ManyToManyField or a ForeignKey relationship' % fieldname)
+
+def _generic_foreign_key(model, fieldname):
+    # GenericForeignKeys aren't in the model's field names
+    for field in model._meta.virtual_fields:
+        if field.name == fieldname and isinstance(field, GenericForeignKey):
+            return field
+    return None
+
+def _is_generic_relation(field_object):
+    # a GenericRelation looks like a direct (but not m2m) relation, whose
+    # field object is a RelatedObject for the GenericRelation
+    return isinstance(getattr(field_object, 'field', None), GenericRelation)
 
 def _check_field_exists(model, fieldname):
     try:
         field_object, model, direct, m2m = model._meta.get_field_by_name(fieldname)
     except FieldDoesNotExist:
+        if _generic_foreign_key(model, fieldname) is not None:
+            return fieldname
         # might be after reverse foreign key
         # which by default don't have the name we expect
         if fieldname.endswith('_set'):
@@ -22,10 +71,136 @@ def _check_field_exists(model, fieldname):
         else:
             raise
     if not m2m:
-        if direct: # reverse foreign key relationship
+        if direct and not isinstance(field_object, models.ForeignKey) and \
+                not _is_generic_relation(field_object):
             _not_exists(fieldname)
     return fieldname
 
+class _Relation(object):
+    '''
+    the metadata needed to batch select fieldname on model
+    '''
+    
+    def __init__(self, model, fieldname):
+        self.model = model
+        self.fieldname = _check_field_exists(model, fieldname)
+        self.through = None
+        self.generic_relation = None
+        # lookup used to select the related objects of some ids, for
+        # relations that aren't forward relations
+        self.id_lookup = None
+        
+        generic_foreign_key = _generic_foreign_key(model, self.fieldname)
+        if generic_foreign_key is not None:
+            # the related objects can be of any model
+            self.field_object = generic_foreign_key
+            self.direct = True
+            self.m2m = False
+            self.forward = True
+            self.single = True
+            self.related_model = None
+            self.generic_foreign_key = generic_foreign_key
+            self.ct_attname = model._meta.get_field(generic_foreign_key.ct_field).attname
+            self.attname = generic_foreign_key.fk_field
+            self.cache_name = generic_foreign_key.cache_attr
+            return
+        self.generic_foreign_key = None
+        
+        field_object, model, direct, m2m = \
+            model._meta.get_field_by_name(self.fieldname)
+        self.field_object = field_object
+        self.direct = direct
+        self.m2m = m2m
+        # forward relations point at a single object, as do reverse
+        # one-to-one relations
+        self.forward = direct and not m2m and not _is_generic_relation(field_object)
+        self.single = False
+        
+        if m2m:
+            if not direct:
+                m2m_field = field_object.field
+                self.related_model = field_object.model
+                self.related_name = m2m_field.name
+                self.id_column = m2m_field.m2m_reverse_name()
+                self.db_table = m2m_field.m2m_db_table()
+                self.through = m2m_field.rel.through
+                self.through_source = m2m_field.m2m_reverse_field_name()
+                self.through_target = m2m_field.m2m_field_name()
+            else:
+                m2m_field = field_object
+                # model on other end of relationship
+                self.related_model = m2m_field.rel.to
+                self.related_name = m2m_field.related_query_name()
+                self.id_column = m2m_field.m2m_column_name()
+                self.db_table  = m2m_field.m2m_db_table()
+                self.through = getattr(m2m_field.rel, 'through', None)
+                if self.through is not None:
+                    self.through_source = m2m_field.m2m_field_name()
+                    self.through_target = m2m_field.m2m_reverse_field_name()
+                if isinstance(m2m_field, GenericRelation):
+                    self.generic_relation = m2m_field
+        elif _is_generic_relation(field_object):
+            # the related objects point back with their object id field
+            generic_relation = self.generic_relation = field_object.field
+            self.related_model = generic_relation.rel.to
+            self.related_name = generic_relation.object_id_field_name
+            self.id_lookup = '%s__in' % self.related_name
+            self.id_column = self.related_model._meta.get_field(self.related_name).column
+            self.db_table = self.related_model._meta.db_table
+        elif direct:
+            # forward foreign key (and one-to-one) relationships, where
+            # the related objects are selected by the field they point at
+            related_field = field_object.rel.get_related_field()
+            self.related_model = field_object.rel.to
+            self.related_name = related_field.name
+            self.related_attname = related_field.attname
+            self.attname = field_object.attname
+            self.id_column = field_object.column
+            self.db_table = self.model._meta.db_table
+            self.single = True
+            self.cache_name = field_object.get_cache_name()
+        else:
+            # handle reverse foreign key relationships
+            fk_field = field_object.field
+            self.related_model = field_object.model
+            self.related_name  = fk_field.name
+            self.id_column = fk_field.column
+            self.db_table = self.related_model._meta.db_table
+            if isinstance(fk_field, models.OneToOneField):
+                self.single = True
+                self.cache_name = field_object.get_cache_name()
+    
+    def generic_filter(self, using=DEFAULT_DB_ALIAS):
+        # the content type isn't kept with the rest of the metadata, as
+        # it comes from the database (ContentType caches it anyway)
+        if self.generic_relation is not None:
+            ct_field_name = self.generic_relation.content_type_field_name
+            content_types = ContentType.objects.db_manager(using)
+            ct_pk = content_types.get_for_model(self.generic_relation.model).pk
+            return {ct_field_name: ct_pk}
+        return False
+
+# _Relation objects keyed by (model, fieldname)
+_relation_cache = {}
+
+def _resolve_relation(model, fieldname):
+    key = (model, fieldname)
+    relation = _relation_cache.get(key)
+    if relation is None:
+        relation = _relation_cache[key] = _Relation(model, fieldname)
+    return relation
+
+def _clear_relation_cache(**kwargs):
+    _relation_cache.clear()
+    _raw_query_cache.clear()
+
+# adding a model can add (reverse) relations to other models
+class_prepared.connect(_clear_relation_cache)
+
+# extra select used to number the related rows for each parent,
+# when limiting how many are selected for each one
+_ROW_NUMBER_ATTR = '__row_number'
+
 def _id_attr(id_column):
     # mangle the id column name, so we can make sure
     # the postgres doesn't complain about not quoting
@@ -33,19 +208,55 @@ def _id_attr(id_column):
     # with the regular id column)
     return '__%s' % id_column.lower()
 
-def _select_related_instances(related_model, related_name, ids, db_table, id_column, generic):
-    id__in_filter={ ('%s__pk__in' % related_name): ids }
+def _chunk_size(connection, chunk_size=None):
+    # work out how many parent ids we can safely send in one query,
+    # either from the argument, the BATCH_SELECT_CHUNK_SIZE setting
+    # (an int, or a dict keyed by database vendor) or the defaults
+    # for this backend
+    if chunk_size is None:
+        chunk_size = _chunk_size_setting(connection)
+    if chunk_size is None:
+        chunk_size = DEFAULT_CHUNK_SIZES.get(connection.vendor,
+                                             DEFAULT_CHUNK_SIZE)
+    if chunk_size < 1:
+        raise ValueError('chunk_size must be a positive integer')
+    return chunk_size
+
+def _chunk_size_setting(connection):
+    chunk_size = getattr(settings, 'BATCH_SELECT_CHUNK_SIZE', None)
+    if isinstance(chunk_size, dict):
+        chunk_size = chunk_size.get(connection.vendor)
+    return chunk_size
+
+def _chunked(ids, chunk_size):
+    for start in xrange(0, len(ids), chunk_size):
+        yield ids[start:start + chunk_size]
+
+def _unique(ids):
+    seen = set()
+    unique_ids = []
+    for id in ids:
+        if id not in seen:
+            seen.add(id)
+            unique_ids.append(id)
+    return unique_ids
+
+def _select_related_instances(related_model, related_name, ids, db_table, id_column, generic=False,
+                              using=DEFAULT_DB_ALIAS, id_lookup=None, manager=None):
+    id__in_filter={ (id_lookup or '%s__pk__in' % related_name): ids }
     
     if generic:
         id__in_filter.update(generic)
-    qn = connection.ops.quote_name
+    qn = connections[using].ops.quote_name
     select = { _id_attr(id_column): '%s.%s' % (qn(db_table), qn(id_column)) }
-    related_instances = related_model._default_manager \
+    related_instances = (manager or related_model._default_manager) \
+                            .using(using) \
                             .filter(**id__in_filter) \
                             .extra(select=select)
     return related_instances
 
-def batch_select(model, instances, target_field_name, fieldname, filter=None):
+def batch_select(model, instances, target_field_name, fieldname, filter=None,
+                 **options):
     '''
     basically do an extra-query to select the many-to-many
     field values into the instances given. e.g. so we can get all
@@ -61,63 +272,1017 @@ def batch_select(model, instances, target_field_name, fieldname, filter=None):
     filter is a function that can be used alter the extra-query - it 
     takes a queryset and returns a filtered version of the queryset
     
+    the other keyword arguments are options for the extra-query:
+    
+    chunk_size is the maximum number of ids sent in one extra-query, if
+    there are more instances than this several queries are made (see
+    _chunk_size for the defaults)
+    
+    values or values_list can be given a sequence of field names, to attach
+    dicts or tuples of those fields (as with QuerySet.values() and
+    values_list()) rather than model instances.  flat is as for values_list()
+    
+    aggregate can be an aggregate (e.g. Count('pk')) to attach its value for
+    the related objects of each instance, calculated in the database,
+    rather than the related objects themselves
+    
+    exists can be set to True to attach whether each instance has any
+    related objects, selecting only the distinct ids of those that do
+    
+    limit is the maximum number of related objects to select for each
+    instance.  on databases with window functions the extra rows aren't
+    selected at all, otherwise they are discarded as they are read
+    
+    identity_map can be set to True to select each related object of a
+    ManyToManyField only once (per chunk of instances), and share it
+    between all the instances it is related to, rather than once per
+    instance.  the links between them are
+    selected separately, and any filter only sees the related objects
+    
+    with_through can be given a sequence of field names on the through model
+    of a ManyToManyField, which are selected in the same query and set on
+    each related object (under the same names)
+    
+    parent_queryset can be the (unsliced) queryset the instances came from,
+    in which case the related objects can be selected with a subquery of it
+    rather than a list of the instances' ids.  strategy picks how: "ids" or
+    "subquery" - by default a subquery is used when there are more ids than
+    fit in one query, unless chunk_size (or the BATCH_SELECT_CHUNK_SIZE
+    setting) is given
+    
+    stream can be set to True to order the extra-query by instance (before
+    any other ordering), read it without caching its results, and group the
+    related objects of each instance as they are read
+    
+    using is the database to select the related objects from, by default
+    it's the one router.db_for_read() picks for them (normally the database
+    the instances came from)
+    
+    cache can be set to True to cache the related objects for each instance
+    between calls (see batch_select.cache), for cache_timeout seconds.  if
+    filter is given a cache_signature identifying it must also be given
+    
+    fieldname can also be a forward ForeignKey (or OneToOneField) or a
+    reverse one-to-one relationship, in which case the target field is set
+    to the related object (or None) rather than a list
+    
+    fieldname can also be a path of relations, such as "entry__tags" - in
+    which case each level is selected with one query, the instances get an
+    "entry_all" field and each of the entries then get the target field
+    
     NB: this is a semi-private API at the moment, but may be useful if you
     dont want to change your model/manager.
     '''
     
-    fieldname = _check_field_exists(model, fieldname)
-    
     instances = list(instances)
-    ids = [instance.pk for instance in instances]
+    grouped = _select_grouped(model, instances, fieldname, filter,
+                              target_field_name=target_field_name, **options)
+    
+    target_field_name = _path_field_name(fieldname) or target_field_name
+    for instance in instances:
+        setattr(instance, target_field_name, grouped[instance.pk])
+    
+    return instances
+
+def _select_grouped(model, instances, fieldname, filter=None, chunk_size=None,
+                    values=None, values_list=None, flat=False, aggregate=None,
+                    limit=None, cache=False, cache_timeout=DEFAULT_TIMEOUT,
+                    cache_signature=None, identity_map=False, using=None,
+                    target_field_name=None, with_through=None,
+                    parent_queryset=None, strategy=None, stream=False,
+                    exists=False, compiled_queries=None):
+    '''
+    run the extra-query for batch_select, returning a dict mapping
+    the pk of each instance to a list of its related objects (or the
+    value of aggregate over them, if given, or whether there are any if
+    exists is True).  for relations to a single object the pk is mapped
+    to the object, or None
+    
+    fieldname can also be a path (e.g. "entry__tags"), in which case the
+    related objects of the first relation in the path are returned, having
+    had the rest of the path batch selected into target_field_name
+    '''
+    if LOOKUP_SEP in fieldname:
+        return _select_path(model, instances, fieldname, filter,
+                            target_field_name, using=using,
+                            parent_queryset=parent_queryset, strategy=strategy,
+                            chunk_size=chunk_size, values=values,
+                            values_list=values_list, flat=flat,
+                            aggregate=aggregate, limit=limit, cache=cache,
+                            cache_timeout=cache_timeout,
+                            cache_signature=cache_signature,
+                            identity_map=identity_map,
+                            with_through=with_through, exists=exists,
+                            compiled_queries=compiled_queries)
+    
+    relation = _resolve_relation(model, fieldname)
+    # setting the descriptor's cache means selecting the related object
+    # the way the descriptor would
+    fills_cache = relation.single and target_field_name == relation.cache_name
+    
+    if with_through:
+        if relation.through is None:
+            raise ValueError('with_through() can only be used with a '
+                             'ManyToManyField, not "%s"' % fieldname)
+        if identity_map or values is not None or values_list is not None:
+            raise ValueError('with_through() cannot be used with '
+                             'identity_map(), values() or values_list()')
+        # the values are set under their own names, so mustn't replace
+        # anything the related objects already have
+        related_model = relation.related_model
+        opts = related_model._meta
+        taken = set(opts.get_all_field_names()) | \
+                set(field.attname for field in opts.fields)
+        for name in with_through:
+            if name in taken or hasattr(related_model, name):
+                raise ValueError('with_through() cannot set "%s", as %s '
+                                 'already has it' % (name, opts.object_name))
+    
+    ids = _unique(instance.pk for instance in instances)
+    if not ids:
+        return {}
+    
+    if using is None:
+        # by default this will be the database the instances came from
+        using = router.db_for_read(relation.related_model or model,
+                                   instance=instances[0])
+    connection = connections[using]
+    
+    if cache:
+        if relation.related_model is None:
+            raise ValueError('"%s" cannot be cached, as it can be related to '
+                             'any model' % fieldname)
+        if cache_signature is None:
+            if filter:
+                raise ValueError('a cache_signature is needed to cache a '
+                                 'filtered batch_select')
+            cache_signature = batch_signature((), dict(values=values,
+                    values_list=values_list, flat=flat, limit=limit,
+                    aggregate=aggregate and aggregate.default_alias,
+                    exists=exists))
+        if fills_cache:
+            cache_signature += ':descriptor'
+        cache_prefix = batch_cache.prefix(relation, cache_signature, using)
+        cached = batch_cache.get_many(cache_prefix, ids)
+        ids = [id for id in ids if id not in cached]
+        if not ids:
+            return cached
     
-    field_object, model, direct, m2m = model._meta.get_field_by_name(fieldname)
-    if isinstance(field_object, GenericRelation):
-        ct_field_name = field_object.content_type_field_name
-        ct_pk = ContentType.objects.get_for_model(field_object.model).pk
-        generic = {ct_field_name: ct_pk}
+    # ids are only sent in chunks rather than a subquery if asked to
+    explicit_chunk_size = chunk_size is not None or \
+                          _chunk_size_setting(connection) is not None
+    chunk_size = _chunk_size(connection, chunk_size)
+    
+    if relation.forward:
+        if aggregate is not None or values is not None or \
+                values_list is not None or limit is not None or exists:
+            raise ValueError('aggregates, exists, values(), values_list() and '
+                             'limit() cannot be used with "%s"' % fieldname)
+        if relation.generic_foreign_key is not None:
+            grouped = _select_generic_foreign_key(model, relation, instances,
+                                                  ids, filter, chunk_size,
+                                                  using, fills_cache)
+        else:
+            grouped = _select_forward(model, relation, instances, ids, filter,
+                                      chunk_size, using, fills_cache)
+        if cache:
+            batch_cache.set_many(cache_prefix, grouped, cache_timeout)
+            grouped.update(cached)
+        return grouped
+    
+    # only the related objects themselves are selected by other queries
+    selecting_objects = aggregate is None and not exists
+    
+    if identity_map and relation.through is not None and selecting_objects:
+        if values is not None or values_list is not None:
+            raise ValueError('identity_map() cannot be used with values() '
+                             'or values_list()')
+        grouped = _select_identity_mapped(model, relation, ids, filter,
+                                          chunk_size, limit, using)
+        query_ids = []
     else:
-        generic = False
-    
-    if m2m:
-        if not direct:
-            m2m_field = field_object.field
-            related_model = field_object.model
-            related_name = m2m_field.name
-            id_column = m2m_field.m2m_reverse_name()
-            db_table = m2m_field.m2m_db_table()
+        grouped = {}
+        query_ids = ids
+    
+    if query_ids and _use_subquery(parent_queryset, strategy, using, cache,
+                                   not explicit_chunk_size and len(query_ids) > chunk_size):
+        # let the database work out the parent ids itself
+        chunks = [(query_ids, parent_queryset.order_by().values('pk'))]
+    else:
+        chunks = ((chunk_ids, chunk_ids)
+                  for chunk_ids in _chunked(query_ids, chunk_size))
+    
+    id_attr = _id_attr(relation.id_column)
+    generic = relation.generic_filter(using)
+    # reverse one-to-one descriptors select with the base manager
+    manager = relation.related_model._base_manager if fills_cache else None
+    timer = _BatchTimer(model, relation, using)
+    # plain related objects can be read without building a queryset,
+    # as long as any filter can be compiled once
+    raw = (not filter or compiled_queries is not None) and \
+          selecting_objects and values is None and values_list is None and \
+          limit is None and not with_through and not stream and \
+          getattr(settings, 'BATCH_SELECT_RAW_QUERIES', True)
+    # each parent's related rows all come back in the same chunk, so
+    # the ordering within each group is unaffected by the chunking
+    for chunk_ids, parent_ids in chunks:
+        raw_query = raw and parent_ids is chunk_ids and \
+                    _raw_query(relation, chunk_ids[0], using, generic, filter,
+                               compiled_queries, manager)
+        if raw_query:
+            raw_sql = raw_query.bind(chunk_ids)
+            for instance_id, related_instance in timer.fetch(raw_sql):
+                grouped.setdefault(instance_id, []).append(related_instance)
+            timer.executed(chunk_ids, raw_sql)
+            continue
+        
+        related_instances = _select_related_instances(relation.related_model,
+                                                      relation.related_name,
+                                                      parent_ids,
+                                                      relation.db_table,
+                                                      relation.id_column,
+                                                      generic, using,
+                                                      relation.id_lookup,
+                                                      manager)
+        
+        if filter:
+            related_instances = filter(related_instances)
+        
+        if with_through and selecting_objects:
+            related_instances = _select_through_fields(related_instances,
+                                                       relation, with_through,
+                                                       using)
+        
+        if aggregate is not None:
+            related_instances = _aggregate(related_instances, id_attr, aggregate)
+            grouped.update(timer.fetch(_aggregated_rows(related_instances,
+                                                        id_attr)))
+            timer.executed(chunk_ids, related_instances.query)
+            continue
+        
+        if exists:
+            related_instances = _exists(related_instances, id_attr)
+            grouped.update((instance_id, True) for instance_id in
+                           timer.fetch(related_instances))
+            timer.executed(chunk_ids, related_instances.query)
+            continue
+        
+        extra_attrs = ()
+        if limit is not None and _supports_window_functions(connection) and \
+                not _orders_by_select_alias(related_instances.query):
+            # already ordered by instance
+            related_instances = _limit_per_group(related_instances, relation,
+                                                 limit)
+            extra_attrs = (_ROW_NUMBER_ATTR,)
+        elif stream:
+            related_instances = _order_by_parent(related_instances, id_attr)
+        
+        related_rows = _related_rows(related_instances, id_attr,
+                                     values, values_list, flat, extra_attrs,
+                                     stream)
+        if stream:
+            _group_sorted(grouped, timer.fetch(related_rows), limit,
+                          with_through)
+            timer.executed(chunk_ids, related_instances.query)
+            continue
+        
+        for instance_id, related_instance in timer.fetch(related_rows):
+            group = grouped.get(instance_id, [])
+            if limit is not None and len(group) >= limit:
+                # the database couldn't limit the rows for us
+                continue
+            if with_through:
+                _attach_through_fields(related_instance, with_through)
+            group.append(related_instance)
+            grouped[instance_id] = group
+        timer.executed(chunk_ids, related_instances.query)
+    
+    for id in ids:
+        if id not in grouped:
+            grouped[id] = _missing_value(aggregate, exists)
+    
+    if relation.single and selecting_objects:
+        for id, group in grouped.items():
+            grouped[id] = group[0] if group else None
+    
+    if cache:
+        batch_cache.set_many(cache_prefix, grouped, cache_timeout)
+        grouped.update(cached)
+    
+    return grouped
+
+def _through_attr(name):
+    # mangled like the id column, so it can't clash with the related
+    # model's fields
+    return '__through_%s' % name
+
+def _select_through_fields(related_instances, relation, fields, using):
+    # select the given fields of the through table, which is already
+    # joined to select the parent ids
+    qn = connections[using].ops.quote_name
+    through_opts = relation.through._meta
+    select = {}
+    for name in fields:
+        column = through_opts.get_field(name).column
+        select[_through_attr(name)] = '%s.%s' % (qn(relation.db_table), qn(column))
+    return related_instances.extra(select=select)
+
+def _attach_through_fields(related_instance, fields):
+    for name in fields:
+        value = related_instance.__dict__.pop(_through_attr(name))
+        setattr(related_instance, name, value)
+
+def _order_by_parent(related_instances, id_attr):
+    # order by the parent id, then by whatever the related objects were
+    # going to be ordered by
+    query = related_instances.query
+    ordering = query.extra_order_by or query.order_by
+    if not ordering and query.default_ordering:
+        ordering = related_instances.model._meta.ordering
+    return related_instances.order_by(id_attr, *ordering)
+
+def _group_sorted(grouped, related_rows, limit=None, with_through=None):
+    # the related objects of each parent are read one after the other, so
+    # each group is finished with as soon as the next one starts
+    for instance_id, rows in groupby(related_rows, key=itemgetter(0)):
+        group = [related_instance for _, related_instance in islice(rows, limit)]
+        if with_through:
+            for related_instance in group:
+                _attach_through_fields(related_instance, with_through)
+        grouped[instance_id] = group
+
+def _use_subquery(parent_queryset, strategy, using, cache, chunked):
+    # a subquery selects the related objects of every instance in
+    # parent_queryset, so can't be used for only the uncached ones, and
+    # has to be run on the same database
+    if parent_queryset is None or cache or parent_queryset.db != using:
+        return False
+    if strategy is None:
+        return chunked
+    return strategy == 'subquery'
+
+class _BatchTimer(object):
+    '''
+    times each related query and the stitching in of its rows, and sends
+    batch_executed for it - but only if anything is connected to it
+    '''
+    
+    def __init__(self, model, relation, using):
+        self.model = model
+        self.relation = relation
+        self.using = using
+        self.listening = batch_executed.has_listeners(model)
+    
+    def fetch(self, rows):
+        # read all the rows up front, so reading them can be timed
+        # separately from stitching them in
+        if not self.listening:
+            return rows
+        start = time()
+        rows = list(rows)
+        self.db_time = time() - start
+        self.rows = len(rows)
+        self.stitch_start = time()
+        return rows
+    
+    def executed(self, ids, query):
+        if self.listening:
+            batch_executed.send(sender=self.model,
+                                relation=self.relation.fieldname,
+                                ids=len(ids),
+                                rows=self.rows,
+                                sql=unicode(query),
+                                db_time=self.db_time,
+                                stitch_time=time() - self.stitch_start,
+                                using=self.using)
+
+def _descriptor_queryset(relation, using):
+    # the queryset a forward relation's descriptor selects with
+    related_model = relation.related_model
+    manager = related_model._default_manager
+    if getattr(manager, 'use_for_related_fields', False):
+        return manager.using(using)
+    return QuerySet(related_model).using(using)
+
+def _select_forward(model, relation, instances, ids, filter, chunk_size, using,
+                    fills_cache=False):
+    # select the objects the instances with the given ids point at, each
+    # object being selected only once however many instances point at it
+    values = dict((instance.pk, getattr(instance, relation.attname))
+                  for instance in instances)
+    related_values = _unique(values[id] for id in ids
+                             if values[id] is not None)
+    related_objects = {}
+    timer = _BatchTimer(model, relation, using)
+    for chunk_values in _chunked(related_values, chunk_size):
+        if fills_cache:
+            related_instances = _descriptor_queryset(relation, using)
+        else:
+            related_instances = relation.related_model._default_manager\
+                                        .using(using)
+        related_instances = related_instances.filter(
+            **{'%s__in' % relation.related_name: chunk_values})
+        if filter:
+            related_instances = filter(related_instances)
+        for related_instance in timer.fetch(related_instances):
+            related_value = getattr(related_instance, relation.related_attname)
+            related_objects[related_value] = related_instance
+        timer.executed(chunk_values, related_instances.query)
+    return dict((id, related_objects.get(values[id])) for id in ids)
+
+def _select_generic_foreign_key(model, relation, instances, ids, filter,
+                                chunk_size, using, fills_cache=False):
+    # select the objects of each content type the instances point at with
+    # one query (per chunk), rather than one per instance
+    content_types = ContentType.objects.db_manager(using)
+    ids = set(ids)
+    keys = {}
+    object_ids = {}
+    for instance in instances:
+        ct_id = getattr(instance, relation.ct_attname)
+        object_id = getattr(instance, relation.attname)
+        if instance.pk in ids and ct_id is not None and object_id is not None:
+            # get_for_id() caches the content types
+            related_model = content_types.get_for_id(ct_id).model_class()
+            object_id = related_model._meta.pk.get_prep_value(object_id)
+            keys[instance.pk] = (ct_id, object_id)
+            object_ids.setdefault(ct_id, []).append(object_id)
+    
+    related_objects = {}
+    timer = _BatchTimer(model, relation, using)
+    for ct_id, ct_object_ids in object_ids.items():
+        related_model = content_types.get_for_id(ct_id).model_class()
+        # the descriptor selects with the base manager
+        if fills_cache:
+            manager = related_model._base_manager
+        else:
+            manager = related_model._default_manager
+        for chunk_ids in _chunked(_unique(ct_object_ids), chunk_size):
+            related_instances = manager.using(using).filter(pk__in=chunk_ids)
+            if filter:
+                related_instances = filter(related_instances)
+            for related_instance in timer.fetch(related_instances):
+                related_objects[(ct_id, related_instance.pk)] = related_instance
+            timer.executed(chunk_ids, related_instances.query)
+    return dict((id, related_objects.get(keys.get(id))) for id in ids)
+
+def _select_identity_mapped(model, relation, ids, filter, chunk_size, limit,
+                            using):
+    # select the (parent, related) pairs from the through table and
+    # then each related object once per chunk of parents, so every
+    # parent sharing a related object shares a single instance of it
+    through = relation.through._default_manager.using(using)
+    source, target = relation.through_source, relation.through_target
+    related_manager = relation.related_model._default_manager.using(using)
+    timer = _BatchTimer(model, relation, using)
+    related_objects = {}
+    grouped = {}
+    for chunk_ids in _chunked(ids, chunk_size):
+        chunk_links = through.filter(**{'%s__in' % source: chunk_ids})
+        chunk_pairs = chunk_links.values_list(source, target)
+        pairs = list(timer.fetch(chunk_pairs))
+        timer.executed(chunk_ids, chunk_pairs.query)
+        if not pairs:
+            continue
+        
+        # all the related objects of the chunk's instances are selected
+        # in one query (using a subquery of the links, rather than their
+        # ids, of which there could be any number), so that the batch's
+        # ordering holds for each instance
+        related_instances = related_manager.filter(
+                                pk__in=chunk_links.values(target))
+        if filter:
+            related_instances = filter(related_instances)
+        positions = {}
+        for related_instance in timer.fetch(related_instances):
+            positions[related_instance.pk] = len(positions)
+            # objects shared with earlier chunks' instances are kept
+            related_objects.setdefault(related_instance.pk, related_instance)
+        timer.executed(chunk_ids, related_instances.query)
+        
+        chunk_grouped = {}
+        for instance_id, related_id in pairs:
+            if related_id in positions:
+                chunk_grouped.setdefault(instance_id, []).append(related_id)
+        for instance_id, group in chunk_grouped.items():
+            group.sort(key=positions.get)
+            if limit is not None:
+                del group[limit:]
+            grouped[instance_id] = [related_objects[related_id]
+                                    for related_id in group]
+    return grouped
+
+def _select_path(model, instances, path, filter, target_field_name,
+                 using=None, parent_queryset=None, strategy=None, **options):
+    # select each level of the path with one query for all the objects
+    # at that level, with each object at a level only selected (and
+    # kept) once, no matter how many objects it is related to
+    fieldname, rest = path.split(LOOKUP_SEP, 1)
+    grouped = _select_grouped(model, instances, fieldname, using=using,
+                              parent_queryset=parent_queryset,
+                              strategy=strategy)
+    related = _deduplicate(instances, grouped)
+    
+    relation = _resolve_relation(model, fieldname)
+    related_grouped = _select_grouped(relation.related_model, related, rest,
+                                      filter, target_field_name=target_field_name,
+                                      using=using, strategy=strategy, **options)
+    # objects selected with through fields are kept separate, as each
+    # one has the values of a different link
+    if LOOKUP_SEP not in rest and options.get('aggregate') is None and \
+            not options.get('exists') and options.get('values') is None and \
+            options.get('values_list') is None and \
+            not options.get('with_through'):
+        _deduplicate(related, related_grouped)
+    
+    related_field_name = _path_field_name(rest) or target_field_name
+    for related_instance in related:
+        setattr(related_instance, related_field_name,
+                related_grouped[related_instance.pk])
+    return grouped
+
+def _deduplicate(instances, grouped):
+    # make sure each related object only appears once in the groups,
+    # returning the related objects
+    related = []
+    related_by_pk = {}
+    
+    def _shared(related_instance):
+        if related_instance.pk not in related_by_pk:
+            related_by_pk[related_instance.pk] = related_instance
+            related.append(related_instance)
+        return related_by_pk[related_instance.pk]
+    
+    for id in _unique(instance.pk for instance in instances):
+        group = grouped[id]
+        if isinstance(group, list):
+            group[:] = [_shared(related_instance) for related_instance in group]
+        elif group is not None:
+            grouped[id] = _shared(group)
+    return related
+
+def _as_list(related):
+    # the related objects of a relation, whether it has many or one (or none)
+    if isinstance(related, list):
+        return related
+    if related is None:
+        return []
+    return [related]
+
+def _merge_path(related, other_related, path, target_field_name):
+    # copy what was selected for path from other_related onto the matching
+    # related objects, so paths with the same start don't replace each other
+    other_related = dict((other.pk, other) for other in _as_list(other_related))
+    field_name = _path_field_name(path) or target_field_name
+    for related_instance in _as_list(related):
+        other = other_related.get(related_instance.pk)
+        if other is None:
+            continue
+        if LOOKUP_SEP in path and hasattr(related_instance, field_name):
+            _merge_path(getattr(related_instance, field_name),
+                        getattr(other, field_name),
+                        path.split(LOOKUP_SEP, 1)[1], target_field_name)
         else:
-            m2m_field = field_object
-            related_model = m2m_field.rel.to # model on other end of relationship
-            related_name = m2m_field.related_query_name()
-            id_column = m2m_field.m2m_column_name()
-            db_table  = m2m_field.m2m_db_table()
-    elif not direct:
-        # handle reverse foreign key relationships
-        fk_field = field_object.field
-        related_model = field_object.model
-        related_name  = fk_field.name
-        id_column = fk_field.column
-        db_table = related_model._meta.db_table
-    
-    related_instances = _select_related_instances(related_model, related_name, 
-                                                  ids, db_table, id_column,
-                                                  generic)
+            setattr(related_instance, field_name, getattr(other, field_name))
+
+def _path_field_name(fieldname):
+    # the field the objects being batch selected get for a path
+    if LOOKUP_SEP in fieldname:
+        return '%s_all' % fieldname.split(LOOKUP_SEP, 1)[0]
+    return None
+
+def _resolve_path(model, path):
+    # check every relation in path exists, returning the last one
+    for fieldname in path.split(LOOKUP_SEP):
+        if model is None:
+            raise FieldDoesNotExist('"%s" cannot be followed by another '
+                                    'relation, as it can be related to any '
+                                    'model' % relation.fieldname)
+        relation = _resolve_relation(model, fieldname)
+        model = relation.related_model
+    return relation
+
+def _missing_value(aggregate, exists=False):
+    # value used for instances without any related objects
+    if exists:
+        return False
+    if aggregate is None:
+        return []
+    if isinstance(aggregate, Count):
+        return 0
+    return None
+
+def _aggregate(related_instances, id_attr, aggregate):
+    # aggregate the related objects, grouping on the parent id.  any
+    # ordering is cleared, otherwise it would be grouped on too
+    return related_instances.order_by().values(id_attr)\
+                            .annotate(batch_select_value=aggregate)
+
+def _exists(related_instances, id_attr):
+    # select just the (distinct) ids of the parents with related objects,
+    # rather than any of the related objects' columns
+    return related_instances.order_by().values_list(id_attr, flat=True)\
+                            .distinct()
+
+def _aggregated_rows(aggregated, id_attr):
+    # yield (parent pk, aggregated value) pairs
+    for row in aggregated:
+        yield row[id_attr], row['batch_select_value']
+
+def _related_rows(related_instances, id_attr, values=None, values_list=None,
+                  flat=False, extra_attrs=(), stream=False):
+    # yield (parent pk, related object) pairs from the extra-query, where
+    # the related object is a model instance, dict or tuple.  extra_attrs
+    # are any other extra selects that need to be kept in the query but
+    # not in the dicts/tuples.  if stream is True the query's results
+    # aren't cached as they are read
+    if values is not None:
+        fields = list(values)
+        if fields:
+            fields.append(id_attr)
+            fields.extend(extra_attrs)
+        for row in _read(related_instances.values(*fields), stream):
+            for attr in extra_attrs:
+                del row[attr]
+            yield row.pop(id_attr), row
+    elif values_list is not None:
+        fields = list(values_list)
+        if not fields:
+            fields = [f.attname for f in related_instances.model._meta.concrete_fields]
+        fields.extend(extra_attrs)
+        end = len(fields) + 1 - len(extra_attrs)
+        for row in _read(related_instances.values_list(id_attr, *fields),
+                         stream):
+            if flat:
+                yield row[0], row[1]
+            else:
+                yield row[0], row[1:end]
+    else:
+        for related_instance in _read(related_instances, stream):
+            yield getattr(related_instance, id_attr), related_instance
+
+def _read(queryset, stream):
+    if stream:
+        return queryset.iterator()
+    return queryset
+
+# _RawQuery objects (or None, if the related query can't be run raw)
+# keyed by (model, fieldname, database, generic filter)
+_raw_query_cache = {}
+
+# placeholders in compiled sql, skipping escaped percent signs
+_PLACEHOLDER_RE = re.compile(r'%%|%s')
+
+def _raw_query(relation, sample_id, using, generic, filter=None,
+               compiled_queries=None, manager=None):
+    # the related query of a relation, compiled once from the queryset
+    # the ORM would run, with the parent ids left to be filled in.  the
+    # queries of a filter are kept in compiled_queries rather than
+    # _raw_query_cache, as they depend on the filter too
+    if compiled_queries is None:
+        compiled_queries = _raw_query_cache
+    default_manager = relation.related_model._default_manager
+    if manager is None:
+        manager = default_manager
+    key = (relation.model, relation.fieldname, using,
+           generic and tuple(sorted(generic.items())),
+           manager is default_manager)
+    # a manager that filters at run time would otherwise be frozen into
+    # the compiled query
+    manager_sql = _manager_sql(manager, using)
+    if key in compiled_queries:
+        raw_query = compiled_queries[key]
+        if raw_query is not None and raw_query.manager_sql != manager_sql:
+            return None
+        return raw_query
     
+    related_instances = _select_related_instances(relation.related_model,
+                                                  relation.related_name,
+                                                  [sample_id],
+                                                  relation.db_table,
+                                                  relation.id_column,
+                                                  generic, using,
+                                                  relation.id_lookup, manager)
     if filter:
         related_instances = filter(related_instances)
+    if not _can_run_raw(related_instances, connections[using]):
+        compiled_queries[key] = None
+        return None
     
-    grouped = {}
-    id_attr = _id_attr(id_column)
-    for related_instance in related_instances:
-        instance_id = getattr(related_instance, id_attr)
-        group = grouped.get(instance_id, [])
-        group.append(related_instance)
-        grouped[instance_id] = group
+    try:
+        sql, params = related_instances.query.get_compiler(using).as_sql()
+    except EmptyResultSet:
+        return None
+    params = list(params)
+    id_params = [i for i, param in enumerate(params)
+                 if param == sample_id and type(param) is type(sample_id)]
+    if len(id_params) != 1:
+        # can't tell which parameter is the parent id, so try again with
+        # another one next time
+        return None
+    id_param = id_params[0]
+    placeholders = [match for match in _PLACEHOLDER_RE.finditer(sql)
+                    if match.group() == '%s']
+    placeholder = placeholders[id_param]
+    raw_query = compiled_queries[key] = _RawQuery(
+                            relation.related_model, using,
+                            list(related_instances.query.extra_select)[0],
+                            sql[:placeholder.start()], sql[placeholder.end():],
+                            params[:id_param], params[id_param + 1:],
+                            manager_sql)
+    return raw_query
+
+def _manager_sql(manager, using):
+    # the compiled queryset of the manager the related queries are built
+    # on, unless it's a plain manager that can't filter
+    get_queryset = type(manager).get_queryset
+    if get_queryset == models.Manager.get_queryset or \
+            get_queryset == BatchManager.get_queryset:
+        return None
+    try:
+        sql, params = manager.db_manager(using).get_queryset().query\
+                             .get_compiler(using).as_sql()
+    except EmptyResultSet:
+        return EmptyResultSet
+    return sql, tuple(params)
+
+def _can_run_raw(related_instances, connection):
+    # only querysets that just select the related model's fields (along
+    # with the parent ids), and read them as QuerySet.iterator() does
+    # without converting any values, can be run raw
+    query = related_instances.query
+    if type(related_instances).iterator not in (QuerySet.iterator,
+                                                BatchQuerySet.iterator):
+        return False
+    if query.select_related or query.deferred_loading[0] or \
+            query.deferred_loading[1] is False or query.aggregates or \
+            query.low_mark or query.high_mark is not None or \
+            related_instances._known_related_objects or \
+            related_instances._prefetch_related_lookups or \
+            getattr(related_instances, '_batches', None):
+        return False
+    if len(query.extra_select) != 1:
+        return False
+    compiler = connection.ops.compiler('SQLCompiler')
+    return not hasattr(compiler, 'resolve_columns')
+
+# replayed QuerySet methods that can leave out related objects
+_FILTERING_METHODS = ('filter', 'exclude', 'extra')
+
+def _filters_rows(replays):
+    return any(method_name in _FILTERING_METHODS
+               for method_name, args, kwargs in replays)
+
+def _calls_callables(replays):
+    # callable filter values are called whenever the filter is applied,
+    # so the query can't be compiled once and reused
+    values = []
+    for method_name, args, kwargs in replays:
+        values.extend(args)
+        values.extend(kwargs.values())
+    while values:
+        value = values.pop()
+        if isinstance(value, Node):
+            # Q objects
+            values.extend(child[1] if isinstance(child, tuple) else child
+                          for child in value.children)
+        elif isinstance(value, (list, tuple)):
+            values.extend(value)
+        elif callable(value):
+            return True
+    return False
+
+def _plain_init(model):
+    # whether Model.__init__ would only set the fields' attributes
+    if model.__init__ != models.Model.__init__:
+        return False
+    if pre_init.has_listeners(model) or post_init.has_listeners(model):
+        return False
+    for field in model._meta.concrete_fields:
+        for klass in model.__mro__:
+            if hasattr(klass.__dict__.get(field.attname), '__set__'):
+                return False
+    return True
+
+class _RawQuery(object):
+    '''
+    the related query of a relation, with the parent ids to fill in
+    '''
     
-    for instance in instances:
-        setattr(instance, target_field_name, grouped.get(instance.pk, []))
+    def __init__(self, model, using, id_attr, sql_head, sql_tail,
+                 params_head, params_tail, manager_sql=None):
+        self.model = model
+        self.using = using
+        self.id_attr = id_attr
+        self.sql_head = sql_head
+        self.sql_tail = sql_tail
+        self.params_head = params_head
+        self.params_tail = params_tail
+        self.manager_sql = manager_sql
+        self.attnames = [field.attname for field in model._meta.concrete_fields]
+        self.plain_init = _plain_init(model)
     
-    return instances
+    def bind(self, ids):
+        sql = '%s%s%s' % (self.sql_head, ', '.join(['%s'] * len(ids)),
+                          self.sql_tail)
+        return _RawSQL(self, sql, self.params_head + list(ids) + self.params_tail)
+
+class _RawSQL(object):
+    '''
+    the related query for some parent ids, yielding (parent pk, related
+    object) pairs, the same objects as QuerySet.iterator() would create
+    '''
+    
+    def __init__(self, raw_query, sql, params):
+        self.raw_query = raw_query
+        self.sql = sql
+        self.params = params
+    
+    def __unicode__(self):
+        return self.sql % tuple(self.params)
+    
+    def __str__(self):
+        return unicode(self).encode('utf-8')
+    
+    def __iter__(self):
+        raw_query = self.raw_query
+        model, using = raw_query.model, raw_query.using
+        attnames, id_attr = raw_query.attnames, raw_query.id_attr
+        cursor = connections[using].cursor()
+        try:
+            cursor.execute(self.sql, self.params)
+            while True:
+                rows = cursor.fetchmany(GET_ITERATOR_CHUNK_SIZE)
+                if not rows:
+                    break
+                for row in rows:
+                    if raw_query.plain_init:
+                        # skip Model.__init__, as it would only set the
+                        # fields (which is what makes it slow)
+                        instance = model.__new__(model)
+                        instance.__dict__.update(zip(attnames, row[1:]))
+                        instance._state = ModelState()
+                    else:
+                        instance = model(*row[1:])
+                    instance._state.db = using
+                    instance._state.adding = False
+                    setattr(instance, id_attr, row[0])
+                    yield row[0], instance
+        finally:
+            cursor.close()
+
+def _supports_window_functions(connection):
+    if connection.vendor in ('postgresql', 'oracle'):
+        return True
+    if connection.vendor == 'sqlite':
+        from django.db.backends.sqlite3.base import Database
+        return Database.sqlite_version_info >= (3, 25, 0)
+    if connection.vendor == 'mysql':
+        # mariadb 10.2+ also has them
+        return connection.mysql_version >= (8, 0)
+    return False
+
+class _RowNumberLimitQuery(Query):
+    '''
+    wraps the SQL for a query, so that only the rows whose row number
+    (an extra select called _ROW_NUMBER_ATTR) is no more than row_limit
+    are returned
+    '''
+    row_limit = None
+    id_attr = None
+    
+    def clone(self, klass=None, memo=None, **kwargs):
+        if klass is None or issubclass(klass, _RowNumberLimitQuery):
+            kwargs.setdefault('row_limit', self.row_limit)
+            kwargs.setdefault('id_attr', self.id_attr)
+        return super(_RowNumberLimitQuery, self).clone(klass, memo, **kwargs)
+    
+    def get_compiler(self, using=None, connection=None):
+        compiler = super(_RowNumberLimitQuery, self).get_compiler(using, connection)
+        qn = compiler.connection.ops.quote_name
+        as_sql = compiler.as_sql
+        row_limit = self.row_limit
+        id_attr = self.id_attr
+        
+        def _as_sql(*args, **kwargs):
+            sql, params = as_sql(*args, **kwargs)
+            if not sql:
+                return sql, params
+            sql = 'SELECT * FROM (%s) %s WHERE %s <= %%s ORDER BY %s, %s' % (
+                        sql, qn('batch_select_limited'), qn(_ROW_NUMBER_ATTR),
+                        qn(id_attr), qn(_ROW_NUMBER_ATTR))
+            return sql, params + (row_limit,)
+        compiler.as_sql = _as_sql
+        return compiler
+
+def _orders_by_select_alias(query):
+    # extra selects and aggregates are ordered by their aliases, which
+    # can't be used in the ORDER BY of a window
+    if query.extra_order_by:
+        ordering = query.extra_order_by
+    elif not query.default_ordering:
+        ordering = query.order_by
+    else:
+        ordering = query.order_by or query.get_meta().ordering or []
+    for field in ordering:
+        if not isinstance(field, basestring) or field == '?':
+            continue
+        col = get_order_dir(field)[0]
+        if col in query.aggregate_select or \
+                ('.' not in field and col in query.extra):
+            return True
+    return False
+
+def _limit_per_group(related_instances, relation, limit):
+    # number the related rows for each parent with ROW_NUMBER(), in the
+    # order they would be returned in anyway, so the database can return
+    # just the first limit rows of each group
+    query = related_instances.query
+    compiler = query.clone().get_compiler(related_instances.db)
+    compiler.as_sql() # sets up any joins the ordering needs
+    ordering = compiler.get_ordering()[0]
+    
+    qn = compiler.connection.ops.quote_name
+    window = 'PARTITION BY %s.%s' % (qn(relation.db_table), qn(relation.id_column))
+    if ordering:
+        window = '%s ORDER BY %s' % (window, ', '.join(ordering))
+    select = { _ROW_NUMBER_ATTR: 'ROW_NUMBER() OVER (%s)' % window }
+    related_instances = related_instances.extra(select=select)
+    related_instances.query = related_instances.query.clone(
+                                klass=_RowNumberLimitQuery,
+                                row_limit=limit,
+                                id_attr=_id_attr(relation.id_column))
+    return related_instances
+
+def _can_run_concurrently(connection):
+    # each worker thread gets its own connection, which won't
+    # see an in-memory sqlite database or any uncommitted changes
+    # made on this thread's connection
+    if connection.vendor == 'sqlite' and \
+            connection.settings_dict['NAME'] in ('', ':memory:'):
+        return False
+    return not getattr(connection, 'in_atomic_block', False)
+
+def _run_in_thread(fn):
+    try:
+        return fn()
+    finally:
+        # don't leave the worker thread's connections open
+        for conn in connections.all():
+            conn.close()
+
+def _run_concurrently(fns, pool_size):
+    '''
+    call each function on a pool of at most pool_size threads,
+    returning the results in the same order as fns
+    '''
+    pool = ThreadPool(min(pool_size, len(fns)))
+    try:
+        return pool.map(_run_in_thread, fns)
+    finally:
+        pool.close()
+        pool.join()
+
+def _default_target_field_name(fieldname):
+    return '%s_all' % fieldname.split(LOOKUP_SEP)[-1]
+
+def _run_in_background(fn):
+    '''
+    call fn on another thread, returning an AsyncResult for its result
+    '''
+    pool = ThreadPool(1)
+    try:
+        return pool.apply_async(_run_in_thread, (fn,))
+    finally:
+        # the thread exits once fn has been called
+        pool.close()
+
+class _CompletedResult(object):
+    '''
+    an AsyncResult for a result that was worked out straight away
+    '''
+    
+    def __init__(self, value):
+        self.value = value
+    
+    def ready(self):
+        return True
+    
+    def successful(self):
+        return True
+    
+    def wait(self, timeout=None):
+        pass
+    
+    def get(self, timeout=None):
+        return self.value
+
+# options that don't affect which related objects a batch selects
+_UNSIGNED_OPTIONS = ('chunk_size', 'cache', 'cache_timeout', 'using',
+                     'strategy', 'lazy', 'stream', 'target_field_name')
+
+# ways of telling the database which objects to select related objects for
+STRATEGIES = ('ids', 'subquery')
 
 class Batch(Replay):
     # functions on QuerySet that we can invoke via this batch object
@@ -128,14 +1293,340 @@ class Batch(Replay):
     def __init__(self, m2m_fieldname, **filter):
         super(Batch,self).__init__()
         self.m2m_fieldname = m2m_fieldname
-        self.target_field_name = '%s_all' % m2m_fieldname
+        # for a path (e.g. "entry__tags") this is the field on the objects
+        # at the end of the path
+        self.target_field_name = _default_target_field_name(m2m_fieldname)
+        # extra keyword arguments passed on to batch_select()
+        self._options = {}
+        # the related queries compiled from the replays (see _raw_query)
+        self._compiled_queries = {}
         if filter: # add a filter replay method
             self._add_replay('filter', *(), **filter)
     
+    def _add_options(self, **options):
+        cloned = self.clone()
+        cloned._options.update(options)
+        # the options don't change the queries compiled from the replays
+        cloned._compiled_queries = self._compiled_queries
+        return cloned
+    
+    def _select_filter(self):
+        # the filter and compiled queries passed on to batch_select(), the
+        # compiled queries only being kept if the replays can be reused
+        if not self._replays:
+            return None, None
+        if _calls_callables(self._replays):
+            return self.replay, None
+        return self.replay, self._compiled_queries
+    
     def clone(self):
         cloned = super(Batch, self).clone(self.m2m_fieldname)
         cloned.target_field_name = self.target_field_name
+        cloned._options = dict(self._options)
         return cloned
+    
+    def _select_options(self):
+        options = dict((name, value) for name, value in self._options.items()
+                       if name != 'lazy')
+        options['target_field_name'] = self.target_field_name
+        if options.get('cache'):
+            # identify the related objects selected, for the cache keys
+            options = dict(options)
+            signature_options = dict((name, value)
+                                     for name, value in options.items()
+                                     if name not in _UNSIGNED_OPTIONS)
+            if 'aggregate' in signature_options:
+                aggregate = signature_options['aggregate']
+                signature_options['aggregate'] = (aggregate.__class__.__name__,
+                                                  aggregate.lookup,
+                                                  aggregate.extra)
+            options['cache_signature'] = batch_signature(self._replays,
+                                                         signature_options)
+        return options
+    
+    def chunk_size(self, chunk_size):
+        '''
+        maximum number of parent ids to send in one query
+        '''
+        return self._add_options(chunk_size=chunk_size)
+    
+    def values(self, *fields):
+        '''
+        select dicts of the given fields rather than model instances
+        '''
+        return self._add_options(values=fields, values_list=None, flat=False)
+    
+    def values_list(self, *fields, **kwargs):
+        '''
+        select tuples of the given fields rather than model instances
+        (or single values if flat=True)
+        '''
+        flat = kwargs.pop('flat', False)
+        if kwargs:
+            raise TypeError('Unexpected keyword arguments to values_list: %s'
+                    % (list(kwargs),))
+        if flat and len(fields) != 1:
+            raise TypeError("'flat' is only valid when values_list is called with one field.")
+        return self._add_options(values=None, values_list=fields, flat=flat)
+    
+    def aggregate(self, aggregate):
+        '''
+        select the value of aggregate (e.g. Max('id')) over the related
+        objects, rather than the related objects themselves
+        '''
+        return self._add_options(aggregate=aggregate)
+    
+    def limit(self, limit):
+        '''
+        select at most limit related objects for each object (the first
+        ones, according to the ordering of the batch)
+        '''
+        if limit < 0:
+            raise ValueError('limit must not be negative')
+        return self._add_options(limit=limit)
+    
+    def strategy(self, strategy):
+        '''
+        select the related objects using a list of the objects' ids ("ids")
+        or a subquery of the query that selected them ("subquery").  by
+        default a subquery is used if there are too many objects to send
+        their ids in one query, and chunk_size() wasn't used
+        '''
+        if strategy not in STRATEGIES:
+            raise ValueError('strategy must be one of %s' % ', '.join(STRATEGIES))
+        return self._add_options(strategy=strategy)
+    
+    def using(self, alias):
+        '''
+        select the related objects from the given database, rather than
+        the one the router picks (by default the database the objects
+        being batch selected came from)
+        '''
+        return self._add_options(using=alias)
+    
+    def identity_map(self):
+        '''
+        share a single instance of each related object between all the
+        objects it's related to (for ManyToManyFields)
+        '''
+        return self._add_options(identity_map=True)
+    
+    def stream(self):
+        '''
+        order the related objects by the object they are related to first
+        (then by any other ordering), and group them as they are read,
+        rather than holding on to all of them until the query is finished
+        '''
+        return self._add_options(stream=True)
+    
+    def with_through(self, *fields):
+        '''
+        select the given fields of the through model too (for
+        ManyToManyFields), setting them on each related object
+        '''
+        return self._add_options(with_through=fields)
+    
+    def lazy(self):
+        '''
+        don't select the related objects until they are first used, when
+        they are selected for all the objects at once
+        '''
+        return self._add_options(lazy=True)
+    
+    def cache(self, timeout=DEFAULT_TIMEOUT):
+        '''
+        cache the related objects for each object between queries, using
+        the BATCH_SELECT_CACHE cache ("default" by default)
+        '''
+        return self._add_options(cache=True, cache_timeout=timeout)
+
+def _pk(instance_or_pk):
+    return getattr(instance_or_pk, 'pk', instance_or_pk)
+
+def _links_relation(model, fieldname):
+    # the relation for adding/removing links to, which must be through
+    # a through model that only holds the links
+    relation = _resolve_relation(model, fieldname)
+    if relation.through is None:
+        raise ValueError('"%s" is not a ManyToManyField' % fieldname)
+    if not relation.through._meta.auto_created:
+        opts = relation.through._meta
+        raise ValueError('Cannot add or remove links for "%s", as it uses '
+                         'the through model %s.%s' % (fieldname,
+                                                      opts.app_label,
+                                                      opts.object_name))
+    return relation
+
+def _existing_links(relation, ids, using):
+    # {pk: {related pk: through pk}} of the links the objects already have
+    through = relation.through._default_manager.using(using)
+    source, target = relation.through_source, relation.through_target
+    existing = {}
+    for chunk_ids in _chunked(ids, _chunk_size(connections[using])):
+        links = through.filter(**{'%s__in' % source: chunk_ids})\
+                       .values_list('pk', source, target)
+        for through_pk, id, related_id in links:
+            existing.setdefault(id, {})[related_id] = through_pk
+    return existing
+
+def _link_instances(model, links, using):
+    # {pk: object} of the objects links are being changed for, selecting
+    # those only given as pks
+    instances = dict((instance.pk, instance) for instance in links
+                     if isinstance(instance, models.Model))
+    missing = [_pk(instance) for instance in links
+               if not isinstance(instance, models.Model)]
+    objects = model._default_manager.using(using)
+    for chunk_ids in _chunked(missing, _chunk_size(connections[using])):
+        instances.update(objects.in_bulk(chunk_ids))
+    return instances
+
+def _change_links(model, fieldname, links, action, using=None,
+                  send_m2m_changed=True):
+    '''
+    add ("add"), remove ("remove") or set ("set") the links for
+    fieldname, given in a dict of {object: [related objects]} (of objects
+    or pks).  returns the number of links added and removed
+    
+    m2m_changed is sent for each object whose links change (as with
+    add() and remove() on the relation's manager), unless
+    send_m2m_changed is False - in which case batch_m2m_changed is sent
+    once for all the objects instead
+    '''
+    relation = _links_relation(model, fieldname)
+    through = relation.through
+    if using is None:
+        using = router.db_for_write(through)
+    instances = None
+    if send_m2m_changed and m2m_changed.has_listeners(through):
+        instances = _link_instances(model, links, using)
+    links = dict((_pk(instance), set(_pk(related) for related in related_links))
+                 for instance, related_links in links.items())
+    through_opts = through._meta
+    source = through_opts.get_field(relation.through_source).attname
+    target = through_opts.get_field(relation.through_target).attname
+    through_objects = through._default_manager.using(using)
+    
+    def _send(action, changed):
+        if not send_m2m_changed:
+            if changed:
+                batch_m2m_changed.send(sender=through, action=action,
+                                       model=model, relation=relation.fieldname,
+                                       links=changed, using=using)
+        elif instances is not None:
+            for id, related_ids in changed.items():
+                if id in instances:
+                    m2m_changed.send(sender=through, action=action,
+                                     instance=instances[id],
+                                     reverse=not relation.direct,
+                                     model=relation.related_model,
+                                     pk_set=set(related_ids), using=using)
+    
+    with transaction.atomic(using=using):
+        existing = _existing_links(relation, list(links), using)
+        added = {}
+        removed = {}
+        for id, related_ids in links.items():
+            current = existing.get(id, {})
+            if action in ('add', 'set'):
+                added_ids = related_ids.difference(current)
+                if added_ids:
+                    added[id] = added_ids
+            if action == 'remove':
+                removed_ids = related_ids.intersection(current)
+            elif action == 'set':
+                removed_ids = set(current).difference(related_ids)
+            else:
+                removed_ids = None
+            if removed_ids:
+                removed[id] = removed_ids
+        
+        if removed:
+            _send('pre_remove', removed)
+            through_pks = [existing[id][related_id]
+                           for id, related_ids in removed.items()
+                           for related_id in related_ids]
+            for chunk_pks in _chunked(through_pks, _chunk_size(connections[using])):
+                through_objects.filter(pk__in=chunk_pks).delete()
+            _send('post_remove', removed)
+        if added:
+            _send('pre_add', added)
+            through_objects.bulk_create([through(**{source: id, target: related_id})
+                                         for id, related_ids in added.items()
+                                         for related_id in related_ids])
+            _send('post_add', added)
+    
+    count = lambda changed: sum(len(ids) for ids in changed.values())
+    return count(added), count(removed)
+
+class _LazyLoader(object):
+    '''
+    runs a lazy batch the first time any of the objects' related objects
+    are used, replacing the LazyRelated objects with them
+    '''
+    
+    def __init__(self, fetch, results, target_field_name):
+        self.fetch = fetch
+        self.results = results
+        self.target_field_name = target_field_name
+        self.grouped = None
+    
+    def get(self, pk):
+        if self.grouped is None:
+            self.grouped = self.fetch()
+            for result in self.results:
+                setattr(result, self.target_field_name, self.grouped[result.pk])
+            self.fetch = self.results = None
+        return self.grouped[pk]
+
+class LazyRelated(object):
+    '''
+    stands in for the related objects of a lazy batch, until they are used
+    '''
+    
+    def __init__(self, loader, pk):
+        self._loader = loader
+        self._pk = pk
+    
+    @property
+    def value(self):
+        return self._loader.get(self._pk)
+    
+    def __getattr__(self, name):
+        return getattr(self.value, name)
+    
+    def __iter__(self):
+        return iter(self.value)
+    
+    def __len__(self):
+        return len(self.value)
+    
+    def __getitem__(self, index):
+        return self.value[index]
+    
+    def __contains__(self, item):
+        return item in self.value
+    
+    def __nonzero__(self):
+        return bool(self.value)
+    
+    def __eq__(self, other):
+        return self.value == other
+    
+    def __ne__(self, other):
+        return self.value != other
+    
+    def __int__(self):
+        return int(self.value)
+    
+    def __repr__(self):
+        return repr(self.value)
+
+def _with_target_field_name(batch, target_field_name):
+    # a copy of batch, rather than changing a batch that may be reused
+    cloned = batch._add_options()
+    cloned.target_field_name = target_field_name
+    return cloned
 
 class BatchQuerySet(QuerySet):
     
@@ -144,38 +1635,244 @@ class BatchQuerySet(QuerySet):
         batches = getattr(self, '_batches', None)
         if batches:
             query._batches = set(batches)
+        query._batch_pool_size = getattr(self, '_batch_pool_size', None)
         return query
     
-    def _create_batch(self, batch_or_str, target_field_name=None):
+    def _create_batch(self, batch_or_str, target_field_name=None, **options):
         batch = batch_or_str
         if isinstance(batch_or_str, basestring):
             batch = Batch(batch_or_str)
+        if options:
+            batch = batch._add_options(**options)
         if target_field_name:
-            batch.target_field_name = target_field_name
+            batch = _with_target_field_name(batch, target_field_name)
         
-        _check_field_exists(self.model, batch.m2m_fieldname)
+        relation = _resolve_path(self.model, batch.m2m_fieldname)
+        if relation.single and batch._options.get('lazy'):
+            raise ValueError('lazy() cannot be used with "%s", as it is only '
+                             'one object' % batch.m2m_fieldname)
+        if relation.single and batch.target_field_name == \
+                _default_target_field_name(batch.m2m_fieldname) and \
+                not _filters_rows(batch._replays):
+            # fill in the cache used by the relation's descriptor, so
+            # accessing it doesn't need another query.  not when filtered,
+            # as the objects filtered out would be cached as None
+            batch = _with_target_field_name(batch, relation.cache_name)
         return batch
     
+    def _add_batches(self, batches):
+        query = self._clone()
+        query._batches = getattr(self, '_batches', set()) | set(batches)
+        return query
+    
     def batch_select(self, *batches, **named_batches):
-        batches = getattr(self, '_batches', set()) | \
-                  set(self._create_batch(batch) for batch in batches) | \
+        batches = set(self._create_batch(batch) for batch in batches) | \
                   set(self._create_batch(batch, target_field_name) \
                         for target_field_name, batch in named_batches.items())
-        
+        return self._add_batches(batches)
+    
+    def batch_count(self, *batches, **named_batches):
+        '''
+        like batch_select, but only selects the number of related objects
+        for each object (into fields called <name>_count by default)
+        '''
+        count = Count('pk', distinct=True)
+        counts = set()
+        for batch in batches:
+            batch = self._create_batch(batch, aggregate=count)
+            batch.target_field_name = '%s_count' % \
+                                      batch.m2m_fieldname.split(LOOKUP_SEP)[-1]
+            counts.add(batch)
+        for target_field_name, batch in named_batches.items():
+            counts.add(self._create_batch(batch, target_field_name,
+                                          aggregate=count))
+        return self._add_batches(counts)
+    
+    def batch_exists(self, *batches, **named_batches):
+        '''
+        like batch_select, but only selects whether there are any related
+        objects for each object (into fields called has_<name> by default),
+        without selecting the related objects themselves
+        '''
+        exists = set()
+        for batch in batches:
+            batch = self._create_batch(batch, exists=True)
+            batch.target_field_name = 'has_%s' % \
+                                      batch.m2m_fieldname.split(LOOKUP_SEP)[-1]
+            exists.add(batch)
+        for target_field_name, batch in named_batches.items():
+            exists.add(self._create_batch(batch, target_field_name,
+                                          exists=True))
+        return self._add_batches(exists)
+    
+    def batch_aggregate(self, *batches, **named_batches):
+        '''
+        like batch_select, but only selects the value of an aggregate over
+        the related objects of each object, calculated with a GROUP BY
+        query.  keyword arguments can either be an aggregate for the
+        relation named, e.g. entry_set=Max('id') (put into fields called
+        <name>_<aggregate> e.g. entry_set_max), or Batch objects with an
+        aggregate given, e.g. latest=Batch('entry_set').aggregate(Max('id'))
+        '''
+        aggregates = set()
+        for batch in batches:
+            aggregates.add(self._create_batch(batch))
+        for name, batch in named_batches.items():
+            if isinstance(batch, Aggregate):
+                aggregate = batch
+                batch = self._create_batch(name, aggregate=aggregate)
+                batch.target_field_name = '%s_%s' % (
+                                            name.split(LOOKUP_SEP)[-1],
+                                            aggregate.name.lower())
+            else:
+                batch = self._create_batch(batch, name)
+            aggregates.add(batch)
+        for batch in aggregates:
+            if batch._options.get('aggregate') is None:
+                raise ValueError('No aggregate given for "%s"'
+                                 % batch.m2m_fieldname)
+        return self._add_batches(aggregates)
+    
+    def batch_concurrently(self, pool_size=None):
+        '''
+        run the related queries for the batches at the same time, each on
+        its own thread (and database connection).  pool_size is the maximum
+        number of threads, and defaults to the BATCH_SELECT_POOL_SIZE setting
+        '''
+        if pool_size is None:
+            pool_size = getattr(settings, 'BATCH_SELECT_POOL_SIZE',
+                                DEFAULT_POOL_SIZE)
         query = self._clone()
-        query._batches = batches
+        query._batch_pool_size = pool_size
         return query
     
-    def iterator(self):
+    def batch_add(self, fieldname, links, send_m2m_changed=True):
+        '''
+        add links for the ManyToManyField (or reverse) fieldname to lots
+        of objects at once, given a dict of {object: [related objects]}
+        (objects or their pks).  the existing links are selected with one
+        query and the new ones are added with bulk inserts.
+        m2m_changed is sent for each object whose links are added to,
+        unless send_m2m_changed is False - in which case batch_m2m_changed
+        is sent once for all of them.  returns the number of links added
+        '''
+        return _change_links(self.model, fieldname, links, 'add', self._db,
+                             send_m2m_changed)[0]
+    
+    def batch_remove(self, fieldname, links, send_m2m_changed=True):
+        '''
+        like batch_add, but removes the links given.  returns the number of
+        links removed
+        '''
+        return _change_links(self.model, fieldname, links, 'remove', self._db,
+                             send_m2m_changed)[1]
+    
+    def batch_set(self, fieldname, links, send_m2m_changed=True):
+        '''
+        like batch_add, but also removes any other links the objects had.
+        returns the number of links added and removed
+        '''
+        return _change_links(self.model, fieldname, links, 'set', self._db,
+                             send_m2m_changed)
+    
+    def abatch_fetch(self, pool_size=None):
+        '''
+        evaluate the query and run its batches (concurrently, as with
+        batch_concurrently()) on other threads, returning straight away
+        with an AsyncResult - whose get() method waits for and returns the
+        list of objects
+        
+        when the queries can't be run on other threads (see
+        batch_concurrently()) they are run before returning instead
+        '''
+        query = self.batch_concurrently(pool_size)
+        fetch = partial(list, query)
+        if not _can_run_concurrently(connections[self.db]):
+            return _CompletedResult(fetch())
+        return _run_in_background(fetch)
+    
+    def _run_batches(self, results, batches, parent_queryset=None):
+        results = list(results)
+        # run (and stitch) the batches in a consistent order, shortest
+        # paths first so longer ones can be merged into what's already
+        # selected
+        batches = sorted(batches, key=lambda batch: (
+                            batch.m2m_fieldname.count(LOOKUP_SEP),
+                            batch.target_field_name))
+        fetches = []
+        for batch in batches:
+            filter, compiled_queries = batch._select_filter()
+            fetches.append(partial(_select_grouped, self.model, results,
+                                   batch.m2m_fieldname, filter,
+                                   compiled_queries=compiled_queries,
+                                   parent_queryset=parent_queryset,
+                                   **batch._select_options()))
+        target_field_names = [_path_field_name(batch.m2m_fieldname) or
+                              batch.target_field_name for batch in batches]
+        
+        # lazy batches are left until they're used, unless another batch
+        # needs merging with them
+        lazy = [batch._options.get('lazy') and
+                target_field_names.count(target_field_name) == 1
+                for batch, target_field_name in zip(batches, target_field_names)]
+        for is_lazy, fetch, target_field_name in zip(lazy, fetches,
+                                                     target_field_names):
+            if is_lazy:
+                loader = _LazyLoader(fetch, results, target_field_name)
+                for result in results:
+                    setattr(result, target_field_name,
+                            LazyRelated(loader, result.pk))
+        
+        batches, fetches = zip(*[(batch, fetch) for batch, fetch, is_lazy
+                                 in zip(batches, fetches, lazy)
+                                 if not is_lazy]) or ((), ())
+        pool_size = getattr(self, '_batch_pool_size', None)
+        if pool_size and len(fetches) > 1 and \
+                _can_run_concurrently(connections[self.db]):
+            groups = _run_concurrently(fetches, pool_size)
+        else:
+            groups = [fetch() for fetch in fetches]
+        
+        stitched = set()
+        for batch, grouped in zip(batches, groups):
+            target_field_name = _path_field_name(batch.m2m_fieldname) or \
+                                batch.target_field_name
+            if target_field_name in stitched:
+                # another batch selected the start of this path already
+                rest = batch.m2m_fieldname.split(LOOKUP_SEP, 1)[1]
+                for result in results:
+                    _merge_path(getattr(result, target_field_name),
+                                grouped[result.pk], rest,
+                                batch.target_field_name)
+                continue
+            stitched.add(target_field_name)
+            for result in results:
+                setattr(result, target_field_name, grouped[result.pk])
+        return results
+    
+    def _iter_chunks(self, result_iter, batches, chunk_size):
+        while True:
+            results = list(islice(result_iter, chunk_size))
+            if not results:
+                break
+            for result in self._run_batches(results, batches):
+                yield result
+    
+    def iterator(self, chunk_size=None):
+        '''
+        if chunk_size is given the results are read chunk_size at
+        a time, with the batches being run for each chunk in turn, so
+        that only one chunk's worth of objects is held in memory at once
+        '''
         result_iter = super(BatchQuerySet, self).iterator()
         batches = getattr(self, '_batches', None)
         if batches:
-            results = list(result_iter)
-            for batch in batches:
-                results = batch_select(self.model, results,
-                                       batch.target_field_name,
-                                       batch.m2m_fieldname,
-                                       batch.replay)
+            if chunk_size:
+                return self._iter_chunks(result_iter, batches, chunk_size)
+            # a sliced query can't be used as a subquery (on all databases)
+            parent_queryset = self if self.query.can_filter() else None
+            results = self._run_batches(list(result_iter), batches,
+                                        parent_queryset)
             return iter(results)
         return result_iter
 
@@ -183,10 +1880,31 @@ class BatchManager(models.Manager):
     use_for_related_fields = True
     
     def get_queryset(self):
-        return BatchQuerySet(self.model)
+        return BatchQuerySet(self.model, using=self._db)
     
     def batch_select(self, *batches, **named_batches):
         return self.all().batch_select(*batches, **named_batches)
+    
+    def batch_count(self, *batches, **named_batches):
+        return self.all().batch_count(*batches, **named_batches)
+    
+    def batch_exists(self, *batches, **named_batches):
+        return self.all().batch_exists(*batches, **named_batches)
+    
+    def batch_aggregate(self, *batches, **named_batches):
+        return self.all().batch_aggregate(*batches, **named_batches)
+    
+    def abatch_fetch(self, pool_size=None):
+        return self.all().abatch_fetch(pool_size)
+    
+    def batch_add(self, fieldname, links, send_m2m_changed=True):
+        return self.all().batch_add(fieldname, links, send_m2m_changed)
+    
+    def batch_remove(self, fieldname, links, send_m2m_changed=True):
+        return self.all().batch_remove(fieldname, links, send_m2m_changed)
+    
+    def batch_set(self, fieldname, links, send_m2m_changed=True):
+        return self.all().batch_set(fieldname, links, send_m2m_changed)
 
 if getattr(settings, 'TESTING_BATCH_SELECT', False):
     class Tag(models.Model):
@@ -202,17 +1920,74 @@ if getattr(settings, 'TESTING_BATCH_SELECT', False):
     class Location(models.Model):
         name = models.CharField(max_length=32)
     
+    class Comment(models.Model):
+        content_type = models.ForeignKey(ContentType, blank=True, null=True)
+        object_id = models.PositiveIntegerField(blank=True, null=True)
+        content_object = GenericForeignKey()
+        text = models.CharField(max_length=255)
+        
+        objects = BatchManager()
+    
     class Entry(models.Model):
         title = models.CharField(max_length=255)
         section  = models.ForeignKey(Section, blank=True, null=True)
         location = models.ForeignKey(Location, blank=True, null=True)
         tags = models.ManyToManyField(Tag)
+        comments = GenericRelation(Comment)
         
         objects = BatchManager()
     
+    class Review(models.Model):
+        entry = models.OneToOneField(Entry)
+        rating = models.IntegerField(default=0)
+        
+        objects = BatchManager()
+    
+    class Collection(models.Model):
+        name = models.CharField(max_length=32)
+        tags = models.ManyToManyField(Tag, through='CollectionTag')
+        
+        objects = BatchManager()
+    
+    class CollectionTag(models.Model):
+        collection = models.ForeignKey(Collection)
+        tag = models.ForeignKey(Tag)
+        position = models.IntegerField(default=0)
+        date_added = models.DateField(blank=True, null=True)
+    
     class Country(models.Model):
         # non id pk
         name = models.CharField(primary_key=True, max_length=100)
         locations = models.ManyToManyField(Location)
         
         objects = BatchManager()
+    
+    # the minimum score of the notes returned by Note.objects, which
+    # can be changed at run time
+    NOTE_FILTER = {'min_score': 0}
+    
+    class NoteManager(BatchManager):
+        def get_queryset(self):
+            return super(NoteManager, self).get_queryset()\
+                        .filter(score__gte=NOTE_FILTER['min_score'])
+    
+    class Note(models.Model):
+        entry = models.ForeignKey(Entry)
+        score = models.IntegerField(default=0)
+        
+        objects = NoteManager()
+    
+    class HighlightManager(BatchManager):
+        # so the descriptors don't filter
+        use_for_related_fields = False
+        
+        def get_queryset(self):
+            return super(HighlightManager, self).get_queryset()\
+                        .filter(live=True)
+    
+    class Highlight(models.Model):
+        note = models.OneToOneField(Note)
+        parent = models.ForeignKey('self', blank=True, null=True)
+        live = models.BooleanField(default=True)
+        
+        objects = HighlightManager()
@@ -0,0 +1,32 @@
+'''
+Signals sent by batch_select, e.g. for collecting metrics.
+'''
+from django.dispatch import Signal
+
+# sent after each query batch_select makes for related objects, with the
+# model being batch selected as the sender and:
+#
+# relation - name of the relation being selected
+# ids - number of objects the related objects were selected for
+# rows - number of rows selected
+# sql - the SQL of the query (as given by unicode(queryset.query))
+# db_time - seconds taken running the query and reading its rows
+# stitch_time - seconds taken attaching the rows to the objects
+# using - the database the query was run on
+#
+# the rows are only timed when something is connected to the signal
+batch_executed = Signal(providing_args=['relation', 'ids', 'rows', 'sql',
+                                        'db_time', 'stitch_time', 'using'])
+
+# sent (with the through model as the sender) before and after links are
+# added or removed by BatchQuerySet.batch_add(), batch_set() and
+# batch_remove() with send_m2m_changed=False, instead of m2m_changed being
+# sent for every object:
+#
+# action - "pre_add", "post_add", "pre_remove" or "post_remove"
+# model - the model the links were added to (or removed from)
+# relation - name of the ManyToManyField (or its reverse)
+# links - dict of {pk: set of related pks} of the links added or removed
+# using - the database the links were changed in
+batch_m2m_changed = Signal(providing_args=['action', 'model', 'relation',
+                                           'links', 'using'])
@@ -3,12 +3,25 @@ from django.conf import settings
 if getattr(settings, 'TESTING_BATCH_SELECT', False):
     from django.test import TransactionTestCase
     from django.db.models.fields import FieldDoesNotExist
-    from batch_select.models import Tag, Entry, Section, Batch, Location,\
+    from batch_select.models import Tag, Entry, Section, Batch, Location, Review,\
+                                    Collection, CollectionTag, Comment,\
                                     _select_related_instances, Country,\
-                                    _check_field_exists
+                                    _check_field_exists, _chunk_size,\
+                                    DEFAULT_CHUNK_SIZE, _run_concurrently,\
+                                    _can_run_concurrently, _resolve_relation,\
+                                    _relation_cache, _supports_window_functions,\
+                                    DEFAULT_CHUNK_SIZES, _run_in_background,\
+                                    _BatchTimer, _raw_query_cache, Note,\
+                                    NOTE_FILTER, Highlight
     from batch_select.replay import Replay
+    from batch_select.cache import batch_cache
+    from batch_select.signals import batch_executed, batch_m2m_changed
+    from django.contrib.contenttypes.models import ContentType
     from django import db
-    from django.db.models import Count
+    from django.db.models import Count, Max, Min, Sum
+    from django.db.models.signals import class_prepared, m2m_changed
+    from datetime import date
+    import threading
     import unittest
     
     def with_debug_queries(fn):
@@ -26,6 +39,12 @@ if getattr(settings, 'TESTING_BATCH_SELECT', False):
     def _create_entries(count):
         return [Entry.objects.create() for _ in xrange(count)]
     
+    class FakeConnection(object):
+        def __init__(self, vendor, name=':memory:', in_atomic_block=False):
+            self.vendor = vendor
+            self.settings_dict = {'NAME': name}
+            self.in_atomic_block = in_atomic_block
+    
     class TestBatchSelect(TransactionTestCase):
         
         def test_batch_select_empty(self):
@@ -556,6 +575,1704 @@ if getattr(settings, 'TESTING_BATCH_SELECT', False):
             self.failUnlessEqual(3, len(db.connection.queries))
 
 
+    class TestBatchSelectChunking(TransactionTestCase):
+        
+        def setUp(self):
+            super(TestBatchSelectChunking, self).setUp()
+            self.entries = _create_entries(5)
+            self.tag2, self.tag1, self.tag3 = _create_tags('tag2', 'tag1', 'tag3')
+            
+            entry1, entry2, entry3, entry4, entry5 = self.entries
+            entry1.tags.add(self.tag1, self.tag2, self.tag3)
+            entry2.tags.add(self.tag2)
+            entry4.tags.add(self.tag3, self.tag1)
+            entry5.tags.add(self.tag2, self.tag3)
+        
+        def _check_tags(self, entries):
+            self.failUnlessEqual(self.entries, entries)
+            entry1, entry2, entry3, entry4, entry5 = entries
+            self.failUnlessEqual([self.tag1, self.tag2, self.tag3], entry1.tags_all)
+            self.failUnlessEqual([self.tag2],                       entry2.tags_all)
+            self.failUnlessEqual([],                                entry3.tags_all)
+            self.failUnlessEqual([self.tag1, self.tag3],            entry4.tags_all)
+            self.failUnlessEqual([self.tag2, self.tag3],            entry5.tags_all)
+        
+        @with_debug_queries
+        def test_batch_chunk_size(self):
+            db.reset_queries()
+            batch = Batch('tags').order_by('name').chunk_size(2)
+            entries = list(Entry.objects.batch_select(batch).order_by('id'))
+            self._check_tags(entries)
+            
+            # one query for the entries, then ceil(5/2) for the tags
+            self.failUnlessEqual(4, len(db.connection.queries))
+        
+        @with_debug_queries
+        def test_batch_chunk_size_setting(self):
+            old_chunk_size = getattr(settings, 'BATCH_SELECT_CHUNK_SIZE', None)
+            settings.BATCH_SELECT_CHUNK_SIZE = {db.connection.vendor: 4}
+            try:
+                db.reset_queries()
+                batch = Batch('tags').order_by('name')
+                entries = list(Entry.objects.batch_select(batch).order_by('id'))
+                self._check_tags(entries)
+                self.failUnlessEqual(3, len(db.connection.queries))
+            finally:
+                settings.BATCH_SELECT_CHUNK_SIZE = old_chunk_size
+        
+        def test_batch_default_chunk_size(self):
+            self.failUnlessEqual(900, _chunk_size(FakeConnection('sqlite')))
+            self.failUnlessEqual(1000, _chunk_size(FakeConnection('oracle')))
+            self.failUnlessEqual(DEFAULT_CHUNK_SIZE,
+                                 _chunk_size(FakeConnection('postgresql')))
+            self.failUnlessEqual(10, _chunk_size(FakeConnection('sqlite'), 10))
+        
+        def test_batch_invalid_chunk_size(self):
+            try:
+                _chunk_size(FakeConnection('sqlite'), 0)
+                self.fail('chunk size of zero allowed')
+            except ValueError:
+                pass
+        
+        @with_debug_queries
+        def test_batch_select_more_ids_than_chunk_size(self):
+            # more entries than sqlite would allow in a single IN clause
+            entries = _create_entries(1200)
+            entries[-1].tags.add(self.tag1)
+            
+            db.reset_queries()
+            entries = list(Entry.objects.batch_select('tags').order_by('id'))
+            
+            self.failUnlessEqual(1205, len(entries))
+            self.failUnlessEqual([self.tag1], entries[-1].tags_all)
+            # the ids are selected with a subquery instead
+            self.failUnlessEqual(2, len(db.connection.queries))
+            
+            db.reset_queries()
+            batch = Batch('tags').strategy('ids')
+            entries = list(Entry.objects.batch_select(batch).order_by('id'))
+            
+            self.failUnlessEqual(1205, len(entries))
+            self.failUnlessEqual([self.tag1], entries[-1].tags_all)
+            self.failUnlessEqual(3, len(db.connection.queries))
+
+
+    class TestBatchSelectIterator(TransactionTestCase):
+        
+        def setUp(self):
+            super(TestBatchSelectIterator, self).setUp()
+            self.entry1, self.entry2, self.entry3 = _create_entries(3)
+            self.tag1, self.tag2 = _create_tags('tag1', 'tag2')
+            
+            self.entry1.tags.add(self.tag1, self.tag2)
+            self.entry3.tags.add(self.tag2)
+        
+        @with_debug_queries
+        def test_iterator_chunk_size(self):
+            db.reset_queries()
+            qs = Entry.objects.batch_select(Batch('tags').order_by('name'))\
+                              .order_by('id')
+            entries = list(qs.iterator(chunk_size=2))
+            
+            self.failUnlessEqual([self.entry1, self.entry2, self.entry3], entries)
+            entry1, entry2, entry3 = entries
+            self.failUnlessEqual([self.tag1, self.tag2], entry1.tags_all)
+            self.failUnlessEqual([],                     entry2.tags_all)
+            self.failUnlessEqual([self.tag2],            entry3.tags_all)
+            
+            # one query for the entries and one per chunk for the tags
+            self.failUnlessEqual(3, len(db.connection.queries))
+        
+        @with_debug_queries
+        def test_iterator_chunk_size_is_lazy(self):
+            qs = Entry.objects.batch_select('tags').order_by('id')
+            db.reset_queries()
+            entries = qs.iterator(chunk_size=2)
+            self.failUnlessEqual(0, len(db.connection.queries))
+            
+            entry1 = entries.next()
+            self.failUnlessEqual(set([self.tag1, self.tag2]), set(entry1.tags_all))
+            self.failUnlessEqual(2, len(db.connection.queries))
+            
+            entries.next()
+            self.failUnlessEqual(2, len(db.connection.queries))
+            
+            entry3 = entries.next()
+            self.failUnlessEqual([self.tag2], entry3.tags_all)
+            self.failUnlessEqual(3, len(db.connection.queries))
+        
+        def test_iterator_chunk_size_no_batches(self):
+            qs = Entry.objects.order_by('id')
+            self.failUnlessEqual([self.entry1, self.entry2, self.entry3],
+                                 list(qs.iterator(chunk_size=2)))
+
+
+    class TestBatchSelectConcurrently(TransactionTestCase):
+        
+        def setUp(self):
+            super(TestBatchSelectConcurrently, self).setUp()
+            self.section1 = Section.objects.create(name='s1')
+            self.location = Location.objects.create(name='home')
+            self.entry1 = Entry.objects.create(section=self.section1,
+                                               location=self.location)
+            self.entry2 = Entry.objects.create(section=self.section1)
+            self.tag1, self.tag2 = _create_tags('tag1', 'tag2')
+            self.entry1.tags.add(self.tag1, self.tag2)
+            self.entry2.tags.add(self.tag2)
+        
+        def test_run_concurrently_keeps_order(self):
+            def _result(i):
+                return lambda: (i, threading.current_thread().name)
+            results = _run_concurrently([_result(i) for i in range(10)], 3)
+            
+            self.failUnlessEqual(range(10), [i for i, _ in results])
+            thread_name = threading.current_thread().name
+            self.failIf(thread_name in set(name for _, name in results))
+            self.failUnless(len(set(name for _, name in results)) <= 3)
+        
+        def test_can_run_concurrently(self):
+            self.failIf(_can_run_concurrently(FakeConnection('sqlite')))
+            self.failIf(_can_run_concurrently(
+                FakeConnection('postgresql', 'db', in_atomic_block=True)))
+            self.failUnless(_can_run_concurrently(FakeConnection('sqlite', 'db')))
+            self.failUnless(_can_run_concurrently(FakeConnection('postgresql', 'db')))
+        
+        def test_batch_concurrently(self):
+            sections = Section.objects.batch_select(Batch('entry').order_by('id'),
+                                                    entries_tags=Batch('entry'))\
+                                      .batch_concurrently(2)
+            section1 = list(sections)[0]
+            self.failUnlessEqual([self.entry1, self.entry2], section1.entry_all)
+            self.failUnlessEqual(set([self.entry1, self.entry2]),
+                                 set(section1.entries_tags))
+            
+            entries = Entry.objects.batch_select('tags', tags_named=Batch('tags'))\
+                                   .batch_concurrently().order_by('id')
+            entry1, entry2 = entries
+            self.failUnlessEqual(set([self.tag1, self.tag2]), set(entry1.tags_all))
+            self.failUnlessEqual(set([self.tag1, self.tag2]), set(entry1.tags_named))
+            self.failUnlessEqual([self.tag2], entry2.tags_all)
+        
+        def test_abatch_fetch(self):
+            # the in-memory test database can't be used from other threads,
+            # so the queries are run straight away
+            result = Entry.objects.batch_select('tags').order_by('id').abatch_fetch()
+            self.failUnless(result.ready())
+            entry1, entry2 = result.get()
+            self.failUnlessEqual(set([self.tag1, self.tag2]), set(entry1.tags_all))
+            self.failUnlessEqual([self.tag2], entry2.tags_all)
+        
+        def test_run_in_background(self):
+            result = _run_in_background(lambda: threading.current_thread().name)
+            self.failIfEqual(threading.current_thread().name, result.get(5))
+        
+        def test_batch_concurrently_cloned(self):
+            qs = Entry.objects.batch_select('tags').batch_concurrently(3)
+            self.failUnlessEqual(3, qs.filter(id=self.entry1.id)._batch_pool_size)
+            self.failUnlessEqual(None, getattr(Entry.objects.all(),
+                                               '_batch_pool_size', None))
+
+
+    class TestRelationCache(TransactionTestCase):
+        
+        def setUp(self):
+            super(TestRelationCache, self).setUp()
+            _relation_cache.clear()
+        
+        def test_resolve_relation_cached(self):
+            relation = _resolve_relation(Section, 'entry_set')
+            self.failUnless(relation is _resolve_relation(Section, 'entry_set'))
+            self.failUnlessEqual('entry', relation.fieldname)
+            self.failUnlessEqual(Entry, relation.related_model)
+            self.failUnlessEqual('section', relation.related_name)
+            self.failUnlessEqual('section_id', relation.id_column)
+            self.failUnlessEqual('batch_select_entry', relation.db_table)
+        
+        def test_resolve_relation_non_existant_field_not_cached(self):
+            try:
+                _resolve_relation(Section, 'qwerty_set')
+                self.fail('selected field that does not exist')
+            except FieldDoesNotExist:
+                pass
+            self.failIf((Section, 'qwerty_set') in _relation_cache)
+        
+        def test_batch_select_introspects_once(self):
+            entry = Entry.objects.create()
+            tag1, = _create_tags('tag1')
+            entry.tags.add(tag1)
+            
+            calls = []
+            get_field_by_name = Entry._meta.get_field_by_name
+            def _counted_get_field_by_name(name):
+                calls.append(name)
+                return get_field_by_name(name)
+            Entry._meta.get_field_by_name = _counted_get_field_by_name
+            try:
+                for _ in range(3):
+                    entry = Entry.objects.batch_select('tags')[0]
+                    self.failUnlessEqual([tag1], entry.tags_all)
+            finally:
+                del Entry._meta.get_field_by_name
+            
+            # only the first batch_select should have looked up the field
+            self.failUnlessEqual(2, calls.count('tags'))
+        
+        def test_class_prepared_clears_cache(self):
+            _resolve_relation(Entry, 'tags')
+            class_prepared.send(sender=Tag)
+            self.failUnlessEqual({}, _relation_cache)
+
+
+    class TestBatchSelectValues(TransactionTestCase):
+        
+        def setUp(self):
+            super(TestBatchSelectValues, self).setUp()
+            self.entry1, self.entry2 = _create_entries(2)
+            self.tag2, self.tag1 = _create_tags('tag2', 'tag1')
+            self.entry1.tags.add(self.tag1, self.tag2)
+        
+        @with_debug_queries
+        def test_batch_values(self):
+            db.reset_queries()
+            batch = Batch('tags').order_by('name').values('id', 'name')
+            entry1, entry2 = Entry.objects.batch_select(batch).order_by('id')
+            
+            self.failUnlessEqual([{'id': self.tag1.id, 'name': 'tag1'},
+                                  {'id': self.tag2.id, 'name': 'tag2'}],
+                                 entry1.tags_all)
+            self.failUnlessEqual([], entry2.tags_all)
+            self.failUnlessEqual(2, len(db.connection.queries))
+        
+        def test_batch_values_all_fields(self):
+            batch = Batch('tags').order_by('name').values()
+            entry1 = Entry.objects.batch_select(batch).order_by('id')[0]
+            self.failUnlessEqual([{'id': self.tag1.id, 'name': 'tag1'},
+                                  {'id': self.tag2.id, 'name': 'tag2'}],
+                                 entry1.tags_all)
+        
+        def test_batch_values_list(self):
+            batch = Batch('tags').order_by('name').values_list('id', 'name')
+            entry1 = Entry.objects.batch_select(batch).order_by('id')[0]
+            self.failUnlessEqual([(self.tag1.id, 'tag1'), (self.tag2.id, 'tag2')],
+                                 entry1.tags_all)
+            
+            batch = Batch('tags').order_by('name').values_list()
+            entry1 = Entry.objects.batch_select(batch).order_by('id')[0]
+            self.failUnlessEqual([(self.tag1.id, 'tag1'), (self.tag2.id, 'tag2')],
+                                 entry1.tags_all)
+        
+        def test_batch_values_list_flat(self):
+            batch = Batch('tags').order_by('-name').values_list('name', flat=True)
+            entry1, entry2 = Entry.objects.batch_select(batch).order_by('id')
+            self.failUnlessEqual(['tag2', 'tag1'], entry1.tags_all)
+            self.failUnlessEqual([], entry2.tags_all)
+        
+        def test_batch_values_list_flat_multiple_fields(self):
+            try:
+                Batch('tags').values_list('id', 'name', flat=True)
+                self.fail('flat allowed with more than one field')
+            except TypeError:
+                pass
+        
+        def test_batch_values_one_to_many(self):
+            section = Section.objects.create(name='s1')
+            self.entry1.section = section
+            self.entry1.save()
+            
+            batch = Batch('entry').values_list('id', flat=True)
+            section = Section.objects.batch_select(batch)[0]
+            self.failUnlessEqual([self.entry1.id], section.entry_all)
+
+
+    class TestBatchCount(TransactionTestCase):
+        
+        def setUp(self):
+            super(TestBatchCount, self).setUp()
+            self.entry1, self.entry2, self.entry3 = _create_entries(3)
+            self.tag1, self.tag2, self.tag3 = _create_tags('tag1', 'tag2', 'tag3')
+            self.entry1.tags.add(self.tag1, self.tag2, self.tag3)
+            self.entry2.tags.add(self.tag2)
+        
+        @with_debug_queries
+        def test_batch_count(self):
+            db.reset_queries()
+            entry1, entry2, entry3 = Entry.objects.batch_count('tags').order_by('id')
+            
+            self.failUnlessEqual(3, entry1.tags_count)
+            self.failUnlessEqual(1, entry2.tags_count)
+            self.failUnlessEqual(0, entry3.tags_count)
+            self.failIf(hasattr(entry1, 'tags_all'))
+            self.failUnlessEqual(2, len(db.connection.queries))
+        
+        def test_batch_count_filtered(self):
+            batch = Batch('tags', name__in=['tag1', 'tag2']).order_by('name')
+            entries = Entry.objects.batch_count(batch, tag_count=batch)\
+                                   .order_by('id')
+            entry1, entry2, entry3 = entries
+            
+            self.failUnlessEqual([2, 1, 0], [e.tags_count for e in entries])
+            self.failUnlessEqual([2, 1, 0], [e.tag_count for e in entries])
+        
+        def test_batch_count_one_to_many(self):
+            section1 = Section.objects.create(name='s1')
+            section2 = Section.objects.create(name='s2')
+            Entry.objects.filter(id__in=[self.entry1.id, self.entry2.id])\
+                         .update(section=section1)
+            
+            sections = Section.objects.batch_count('entry_set').order_by('id')
+            self.failUnlessEqual([2, 0], [s.entry_set_count for s in sections])
+        
+        def test_batch_count_with_batch_select(self):
+            entry1 = Entry.objects.batch_select('tags').batch_count('tags')\
+                                  .order_by('id')[0]
+            self.failUnlessEqual(3, entry1.tags_count)
+            self.failUnlessEqual(set([self.tag1, self.tag2, self.tag3]),
+                                 set(entry1.tags_all))
+
+
+    class TestBatchExists(TransactionTestCase):
+        
+        def setUp(self):
+            super(TestBatchExists, self).setUp()
+            self.section1 = Section.objects.create(name='s1')
+            self.section2 = Section.objects.create(name='s2')
+            self.entry1 = Entry.objects.create(section=self.section1, title='a')
+            self.entry2 = Entry.objects.create(section=self.section1, title='b')
+            self.entry3 = Entry.objects.create(title='c')
+            self.tag1, self.tag2 = _create_tags('tag1', 'tag2')
+            self.entry1.tags.add(self.tag1, self.tag2)
+            self.entry2.tags.add(self.tag1)
+        
+        @with_debug_queries
+        def test_batch_exists(self):
+            db.reset_queries()
+            entries = list(Entry.objects.batch_exists('tags').order_by('id'))
+            self.failUnlessEqual(2, len(db.connection.queries))
+            self.failUnlessEqual([True, True, False],
+                                 [entry.has_tags for entry in entries])
+            sql = db.connection.queries[-1]['sql']
+            self.failUnless('DISTINCT' in sql)
+            self.failIf('"batch_select_tag"."name"' in sql)
+        
+        def test_batch_exists_reverse_fk(self):
+            sections = Section.objects.batch_exists('entry_set').order_by('id')
+            self.failUnlessEqual([True, False],
+                                 [section.has_entry_set for section in sections])
+        
+        def test_batch_exists_filtered(self):
+            entries = Entry.objects.batch_exists(has_tag2=Batch('tags', name='tag2'))\
+                                   .order_by('id')
+            self.failUnlessEqual([True, False, False],
+                                 [entry.has_tag2 for entry in entries])
+        
+        def test_batch_exists_path(self):
+            section1, section2 = Section.objects.batch_exists('entry_set__tags')\
+                                                .order_by('id')
+            self.failUnlessEqual([True, True],
+                                 [entry.has_tags for entry in section1.entry_set_all])
+            self.failUnlessEqual([], section2.entry_set_all)
+        
+        def test_batch_exists_forward(self):
+            try:
+                list(Entry.objects.batch_exists('section'))
+                self.fail('batch_exists used with a foreign key')
+            except ValueError:
+                pass
+    
+    class TestBatchAggregate(TransactionTestCase):
+        
+        def setUp(self):
+            super(TestBatchAggregate, self).setUp()
+            self.section1 = Section.objects.create(name='s1')
+            self.section2 = Section.objects.create(name='s2')
+            self.entry1 = Entry.objects.create(section=self.section1, title='a')
+            self.entry2 = Entry.objects.create(section=self.section1, title='b')
+            self.entry3 = Entry.objects.create(title='c')
+            self.tag1, self.tag2 = _create_tags('tag1', 'tag2')
+            self.entry1.tags.add(self.tag1, self.tag2)
+            self.entry2.tags.add(self.tag1)
+        
+        @with_debug_queries
+        def test_batch_aggregate(self):
+            db.reset_queries()
+            sections = Section.objects.batch_aggregate(entry_set=Max('id'),
+                                                       entry=Min('id'))\
+                                      .order_by('id')
+            section1, section2 = sections
+            self.failUnlessEqual(3, len(db.connection.queries))
+            self.failUnlessEqual(self.entry2.id, section1.entry_set_max)
+            self.failUnlessEqual(self.entry1.id, section1.entry_min)
+            self.failUnlessEqual(None, section2.entry_set_max)
+            self.failUnless('GROUP BY' in db.connection.queries[-1]['sql'])
+        
+        def test_batch_aggregate_count(self):
+            entries = Entry.objects.batch_aggregate(tags=Count('id')).order_by('id')
+            self.failUnlessEqual([2, 1, 0], [entry.tags_count for entry in entries])
+        
+        def test_batch_aggregate_filtered(self):
+            batch = Batch('tags', name='tag2').aggregate(Sum('id'))
+            entries = Entry.objects.batch_aggregate(tag2_sum=batch).order_by('id')
+            self.failUnlessEqual([self.tag2.id, None, None],
+                                 [entry.tag2_sum for entry in entries])
+        
+        def test_batch_aggregate_path(self):
+            sections = Section.objects.batch_aggregate(entry_set__tags=Count('id'))\
+                                      .order_by('id')
+            section1, section2 = sections
+            self.failUnlessEqual([(self.entry1, 2), (self.entry2, 1)],
+                                 [(entry, entry.tags_count) for entry in
+                                  sorted(section1.entry_set_all, key=lambda e: e.id)])
+        
+        def test_batch_aggregate_no_aggregate(self):
+            try:
+                Entry.objects.batch_aggregate(Batch('tags'))
+                self.fail('batch aggregated without an aggregate')
+            except ValueError:
+                pass
+    
+    class TestBatchLimit(TransactionTestCase):
+        
+        def setUp(self):
+            super(TestBatchLimit, self).setUp()
+            self.entry1, self.entry2, self.entry3 = _create_entries(3)
+            self.tag1, self.tag2, self.tag3 = _create_tags('tag1', 'tag2', 'tag3')
+            self.entry1.tags.add(self.tag1, self.tag2, self.tag3)
+            self.entry2.tags.add(self.tag2)
+            self.entry3.tags.add(self.tag1, self.tag3)
+        
+        def _check_limited(self):
+            batch = Batch('tags').order_by('-name').limit(2)
+            entry1, entry2, entry3 = Entry.objects.batch_select(batch).order_by('id')
+            self.failUnlessEqual([self.tag3, self.tag2], entry1.tags_all)
+            self.failUnlessEqual([self.tag2],            entry2.tags_all)
+            self.failUnlessEqual([self.tag3, self.tag1], entry3.tags_all)
+            
+            batch = Batch('tags').order_by('name').limit(1).values_list('name', flat=True)
+            entry1, entry2, entry3 = Entry.objects.batch_select(batch).order_by('id')
+            self.failUnlessEqual(['tag1'], entry1.tags_all)
+            self.failUnlessEqual(['tag2'], entry2.tags_all)
+            self.failUnlessEqual(['tag1'], entry3.tags_all)
+            
+            batch = Batch('tags').order_by('name').limit(1).values('name')
+            entry1 = Entry.objects.batch_select(batch).order_by('id')[0]
+            self.failUnlessEqual([{'name': 'tag1'}], entry1.tags_all)
+            
+            section = Section.objects.create(name='s1')
+            Entry.objects.update(section=section)
+            batch = Batch('entry').order_by('-id').limit(2)
+            section = Section.objects.batch_select(batch)[0]
+            self.failUnlessEqual([self.entry3, self.entry2], section.entry_all)
+        
+        @with_debug_queries
+        def test_batch_limit(self):
+            self._check_limited()
+            if _supports_window_functions(db.connection):
+                self.failUnless('ROW_NUMBER()' in db.connection.queries[-1]['sql'])
+        
+        def test_batch_limit_without_window_functions(self):
+            import batch_select.models
+            supports_window_functions = batch_select.models._supports_window_functions
+            batch_select.models._supports_window_functions = lambda connection: False
+            try:
+                self._check_limited()
+            finally:
+                batch_select.models._supports_window_functions = supports_window_functions
+        
+        def _check_limited_by_select_alias(self):
+            batch = Batch('tags').extra(select={'k': '-batch_select_tag.id'})\
+                                 .order_by('k').limit(2)
+            entry1, entry2, entry3 = Entry.objects.batch_select(batch).order_by('id')
+            self.failUnlessEqual([self.tag3, self.tag2], entry1.tags_all)
+            self.failUnlessEqual([self.tag3, self.tag1], entry3.tags_all)
+            
+            batch = Batch('entry').annotate(tag_count=Count('tags'))\
+                                  .order_by('-tag_count', 'id').limit(1)
+            section = Section.objects.create(name='s1')
+            Entry.objects.update(section=section)
+            section = Section.objects.batch_select(batch)[0]
+            self.failUnlessEqual([self.entry1], section.entry_all)
+        
+        @with_debug_queries
+        def test_batch_limit_ordered_by_select_alias(self):
+            # the window can't be ordered by the alias
+            self._check_limited_by_select_alias()
+            self.failIf('ROW_NUMBER()' in db.connection.queries[-1]['sql'])
+        
+        def test_batch_limit_ordered_by_select_alias_without_window_functions(self):
+            import batch_select.models
+            supports_window_functions = batch_select.models._supports_window_functions
+            batch_select.models._supports_window_functions = lambda connection: False
+            try:
+                self._check_limited_by_select_alias()
+            finally:
+                batch_select.models._supports_window_functions = supports_window_functions
+        
+        def test_batch_limit_zero(self):
+            batch = Batch('tags').limit(0)
+            entry1 = Entry.objects.batch_select(batch).order_by('id')[0]
+            self.failUnlessEqual([], entry1.tags_all)
+        
+        def test_batch_limit_negative(self):
+            try:
+                Batch('tags').limit(-1)
+                self.fail('negative limit allowed')
+            except ValueError:
+                pass
+
+
+    class TestBatchCache(TransactionTestCase):
+        
+        def setUp(self):
+            super(TestBatchCache, self).setUp()
+            batch_cache.cache.clear()
+            batch_cache.reset_stats()
+            self.entry1, self.entry2 = _create_entries(2)
+            self.tag1, self.tag2 = _create_tags('tag1', 'tag2')
+            self.entry1.tags.add(self.tag1, self.tag2)
+        
+        def test_batch_cache_backend_reused(self):
+            self.failUnless(batch_cache.cache is batch_cache.cache)
+            old_cache = getattr(settings, 'BATCH_SELECT_CACHE', None)
+            settings.BATCH_SELECT_CACHE = 'other'
+            try:
+                settings.CACHES['other'] = settings.CACHES['default']
+                other = batch_cache.cache
+                self.failIf(other is batch_cache._caches['default'])
+                self.failUnless(other is batch_cache.cache)
+            finally:
+                del settings.CACHES['other']
+                batch_cache._caches.pop('other', None)
+                if old_cache is None:
+                    del settings.BATCH_SELECT_CACHE
+                else:
+                    settings.BATCH_SELECT_CACHE = old_cache
+        
+        def _entries(self, batch=None):
+            batch = batch or Batch('tags').order_by('name').cache()
+            return list(Entry.objects.batch_select(batch).order_by('id'))
+        
+        @with_debug_queries
+        def test_batch_cache(self):
+            entry1, entry2 = self._entries()
+            self.failUnlessEqual([self.tag1, self.tag2], entry1.tags_all)
+            self.failUnlessEqual([], entry2.tags_all)
+            self.failUnlessEqual((0, 2), (batch_cache.hits, batch_cache.misses))
+            
+            db.reset_queries()
+            entry1, entry2 = self._entries()
+            self.failUnlessEqual([self.tag1, self.tag2], entry1.tags_all)
+            self.failUnlessEqual([], entry2.tags_all)
+            self.failUnlessEqual((2, 2), (batch_cache.hits, batch_cache.misses))
+            # only the entries themselves were selected
+            self.failUnlessEqual(1, len(db.connection.queries))
+        
+        @with_debug_queries
+        def test_batch_cache_only_selects_misses(self):
+            self._entries()
+            entry3 = Entry.objects.create()
+            
+            db.reset_queries()
+            entry1, entry2, entry3 = self._entries()
+            self.failUnlessEqual([self.tag1, self.tag2], entry1.tags_all)
+            self.failUnlessEqual([], entry3.tags_all)
+            self.failUnlessEqual((2, 3), (batch_cache.hits, batch_cache.misses))
+            self.failUnlessEqual(2, len(db.connection.queries))
+        
+        def test_batch_cache_m2m_changed(self):
+            self._entries()
+            self.entry2.tags.add(self.tag1)
+            entry1, entry2 = self._entries()
+            self.failUnlessEqual([self.tag1], entry2.tags_all)
+            
+            self.entry1.tags.remove(self.tag2)
+            entry1, entry2 = self._entries()
+            self.failUnlessEqual([self.tag1], entry1.tags_all)
+            
+            self.entry1.tags.clear()
+            entry1, entry2 = self._entries()
+            self.failUnlessEqual([], entry1.tags_all)
+        
+        def test_batch_cache_related_saved_and_deleted(self):
+            self._entries()
+            self.tag1.name = 'tag3'
+            self.tag1.save()
+            entry1, entry2 = self._entries()
+            self.failUnlessEqual(['tag2', 'tag3'], [t.name for t in entry1.tags_all])
+            
+            self.tag2.delete()
+            entry1, entry2 = self._entries()
+            self.failUnlessEqual(['tag3'], [t.name for t in entry1.tags_all])
+        
+        def test_batch_cache_invalidated_without_cached_reads(self):
+            # as if another process (which never read anything from the
+            # cache) changed the tag
+            from batch_select.cache import _model_key
+            batch_cache.cache.clear()
+            self.failUnlessEqual(None, batch_cache.cache.get(_model_key(Tag)))
+            self.tag1.save()
+            generation = batch_cache.cache.get(_model_key(Tag))
+            self.failIfEqual(None, generation)
+            self.tag2.delete()
+            self.failIfEqual(generation, batch_cache.cache.get(_model_key(Tag)))
+        
+        def test_batch_cache_invalidate(self):
+            self._entries()
+            Tag.objects.filter(id=self.tag1.id).update(name='tag3')
+            batch_cache.invalidate(Tag)
+            entry1, entry2 = self._entries()
+            self.failUnlessEqual(['tag2', 'tag3'], [t.name for t in entry1.tags_all])
+        
+        def test_batch_cache_one_to_many(self):
+            section = Section.objects.create(name='s1')
+            batch = Batch('entry').cache()
+            self.failUnlessEqual([], Section.objects.batch_select(batch)[0].entry_all)
+            
+            self.entry1.section = section
+            self.entry1.save()
+            self.failUnlessEqual([self.entry1],
+                                 Section.objects.batch_select(batch)[0].entry_all)
+        
+        def test_batch_cache_separate_batches(self):
+            self._entries()
+            batch = Batch('tags', name='tag2').cache()
+            entry1, entry2 = self._entries(batch)
+            self.failUnlessEqual([self.tag2], entry1.tags_all)
+            
+            entry1, entry2 = Entry.objects.batch_count(batch).order_by('id')
+            self.failUnlessEqual(1, entry1.tags_count)
+            self.failUnlessEqual(0, batch_cache.hits)
+        
+        def test_batch_cache_unkeyable(self):
+            batch = Batch('tags').annotate(Count('entry')).cache()
+            try:
+                self._entries(batch)
+                self.fail('cached batch with an unkeyable replay')
+            except ValueError:
+                pass
+
+
+    class TestBatchIdentityMap(TransactionTestCase):
+        
+        def setUp(self):
+            super(TestBatchIdentityMap, self).setUp()
+            self.entry1, self.entry2, self.entry3 = _create_entries(3)
+            self.tag2, self.tag1, self.tag3 = _create_tags('tag2', 'tag1', 'tag3')
+            self.entry1.tags.add(self.tag1, self.tag2, self.tag3)
+            self.entry2.tags.add(self.tag2)
+            self.entry3.tags.add(self.tag2, self.tag3)
+        
+        @with_debug_queries
+        def test_batch_identity_map(self):
+            entry4 = Entry.objects.create()
+            db.reset_queries()
+            batch = Batch('tags').order_by('name').identity_map()
+            entry1, entry2, entry3, entry4 = Entry.objects.batch_select(batch)\
+                                                          .order_by('id')
+            
+            self.failUnlessEqual([self.tag1, self.tag2, self.tag3], entry1.tags_all)
+            self.failUnlessEqual([self.tag2],                       entry2.tags_all)
+            self.failUnlessEqual([self.tag2, self.tag3],            entry3.tags_all)
+            self.failUnlessEqual([],                                entry4.tags_all)
+            
+            self.failUnless(entry1.tags_all[1] is entry2.tags_all[0])
+            self.failUnless(entry1.tags_all[1] is entry3.tags_all[0])
+            self.failUnless(entry1.tags_all[2] is entry3.tags_all[1])
+            
+            # the entries, their links to the tags, then the tags
+            self.failUnlessEqual(3, len(db.connection.queries))
+        
+        def test_batch_identity_map_filtered_and_limited(self):
+            batch = Batch('tags').exclude(name='tag1').order_by('-name')\
+                                 .limit(1).identity_map()
+            entry1, entry2, entry3 = Entry.objects.batch_select(batch).order_by('id')
+            self.failUnlessEqual([self.tag3], entry1.tags_all)
+            self.failUnlessEqual([self.tag2], entry2.tags_all)
+            self.failUnlessEqual([self.tag3], entry3.tags_all)
+            self.failUnless(entry1.tags_all[0] is entry3.tags_all[0])
+        
+        def test_batch_identity_map_ordering_across_chunks(self):
+            tag4 = Tag.objects.create(name='tag4')
+            self.entry1.tags.add(tag4)
+            self.entry3.tags.add(tag4)
+            batch = Batch('tags').identity_map().order_by('-name').chunk_size(2)
+            entry1, entry2, entry3 = Entry.objects.batch_select(batch).order_by('id')
+            self.failUnlessEqual([tag4, self.tag3, self.tag2, self.tag1],
+                                 entry1.tags_all)
+            self.failUnlessEqual([tag4, self.tag3, self.tag2], entry3.tags_all)
+            # shared by instances in different chunks too
+            self.failUnless(entry1.tags_all[0] is entry3.tags_all[0])
+        
+        def test_batch_identity_map_reverse_m2m(self):
+            tags = Tag.objects.batch_select(Batch('entry').order_by('id')
+                                                          .identity_map())
+            tag2, tag1, tag3 = tags.order_by('id')
+            self.failUnlessEqual([self.entry1, self.entry2, self.entry3],
+                                 tag2.entry_all)
+            self.failUnlessEqual([self.entry1], tag1.entry_all)
+            self.failUnless(tag1.entry_all[0] is tag2.entry_all[0])
+        
+        def test_batch_identity_map_one_to_many(self):
+            # nothing to share, so just selected as normal
+            section = Section.objects.create(name='s1')
+            Entry.objects.update(section=section)
+            batch = Batch('entry').order_by('id').identity_map()
+            section = Section.objects.batch_select(batch)[0]
+            self.failUnlessEqual([self.entry1, self.entry2, self.entry3],
+                                 section.entry_all)
+        
+        def test_batch_identity_map_values(self):
+            batch = Batch('tags').values('name').identity_map()
+            try:
+                list(Entry.objects.batch_select(batch))
+                self.fail('identity_map allowed with values')
+            except ValueError:
+                pass
+
+
+    class TestBatchSelectMultiDb(TransactionTestCase):
+        multi_db = True
+        
+        def setUp(self):
+            super(TestBatchSelectMultiDb, self).setUp()
+            self.entry1, self.entry2 = [Entry.objects.using('other').create()
+                                        for _ in range(2)]
+            self.tag1, self.tag2 = [Tag.objects.using('other').create(name=name)
+                                    for name in ('tag1', 'tag2')]
+            self.entry1.tags.add(self.tag1, self.tag2)
+        
+        def test_batch_select_follows_queryset_db(self):
+            entries = Entry.objects.using('other').batch_select('tags').order_by('id')
+            entry1, entry2 = entries
+            self.failUnlessEqual(set([self.tag1, self.tag2]), set(entry1.tags_all))
+            self.failUnlessEqual([], entry2.tags_all)
+            self.failUnlessEqual('other', entry1.tags_all[0]._state.db)
+            
+            entries = Entry.objects.db_manager('other').batch_count('tags')
+            self.failUnlessEqual(set([0, 2]), set(e.tags_count for e in entries))
+        
+        def test_batch_select_using(self):
+            entry = Entry.objects.create()
+            tag = Tag.objects.create(name='tag3')
+            entry.tags.add(tag)
+            
+            batch = Batch('tags').using('default')
+            entry1 = Entry.objects.using('other').batch_select(batch)\
+                                  .order_by('id')[0]
+            self.failUnlessEqual([tag], entry1.tags_all)
+            self.failUnlessEqual('default', entry1.tags_all[0]._state.db)
+        
+        def test_batch_select_cache_using(self):
+            batch_cache.cache.clear()
+            entry = Entry.objects.create(id=self.entry1.id)
+            entry.tags.add(Tag.objects.create(name='in-default'))
+            
+            batch = Batch('tags').cache()
+            entry1 = Entry.objects.batch_select(batch).get(id=entry.id)
+            self.failUnlessEqual([u'in-default'],
+                                 [tag.name for tag in entry1.tags_all])
+            entry1 = Entry.objects.using('other').batch_select(batch)\
+                                  .get(id=entry.id)
+            self.failUnlessEqual(set([u'tag1', u'tag2']),
+                                 set(tag.name for tag in entry1.tags_all))
+        
+        def test_batch_select_identity_map_using(self):
+            batch = Batch('tags').order_by('name').identity_map()
+            entry1 = Entry.objects.using('other').batch_select(batch)\
+                                  .order_by('id')[0]
+            self.failUnlessEqual([self.tag1, self.tag2], entry1.tags_all)
+            self.failUnlessEqual('other', entry1.tags_all[0]._state.db)
+
+
+    class TestBatchSelectPaths(TransactionTestCase):
+        
+        def setUp(self):
+            super(TestBatchSelectPaths, self).setUp()
+            self.section1 = Section.objects.create(name='s1')
+            self.section2 = Section.objects.create(name='s2')
+            self.entry1 = Entry.objects.create(section=self.section1)
+            self.entry2 = Entry.objects.create(section=self.section1)
+            self.entry3 = Entry.objects.create(section=self.section2)
+            self.tag1, self.tag2, self.tag3 = _create_tags('tag1', 'tag2', 'tag3')
+            self.entry1.tags.add(self.tag1, self.tag3)
+            self.entry2.tags.add(self.tag2, self.tag3)
+        
+        @with_debug_queries
+        def test_batch_select_path(self):
+            db.reset_queries()
+            sections = Section.objects.batch_select('entry_set__tags').order_by('id')
+            section1, section2 = sections
+            
+            self.failUnlessEqual(set([self.entry1, self.entry2]),
+                                 set(section1.entry_set_all))
+            self.failUnlessEqual([self.entry3], section2.entry_set_all)
+            entry1, entry2 = sorted(section1.entry_set_all, key=lambda e: e.id)
+            self.failUnlessEqual(set([self.tag1, self.tag3]), set(entry1.tags_all))
+            self.failUnlessEqual(set([self.tag2, self.tag3]), set(entry2.tags_all))
+            self.failUnlessEqual([], section2.entry_set_all[0].tags_all)
+            
+            # one query per level
+            self.failUnlessEqual(3, len(db.connection.queries))
+            
+            # the same tag reached through different entries is the same object
+            tag3s = [tag for entry in section1.entry_set_all
+                     for tag in entry.tags_all if tag == self.tag3]
+            self.failUnless(tag3s[0] is tag3s[1])
+        
+        def test_batch_select_path_deduplicated(self):
+            tags = Tag.objects.batch_select('entry__tags').order_by('id')
+            tag1, tag2, tag3 = tags
+            self.failUnlessEqual([self.entry1], tag1.entry_all)
+            self.failUnless(tag1.entry_all[0] is
+                            [e for e in tag3.entry_all if e == self.entry1][0])
+            self.failUnlessEqual(set([self.tag1, self.tag3]),
+                                 set(tag1.entry_all[0].tags_all))
+        
+        def test_batch_select_path_batch(self):
+            def _batch():
+                return Batch('entry_set__tags', name__in=['tag1', 'tag2'])\
+                            .order_by('name')
+            sections = Section.objects.batch_select(_batch(), named_tags=_batch())\
+                                      .order_by('id')
+            section1 = sections[0]
+            entries = sorted(section1.entry_set_all, key=lambda e: e.id)
+            self.failUnlessEqual([[self.tag1], [self.tag2]],
+                                 [entry.tags_all for entry in entries])
+            self.failUnlessEqual([[self.tag1], [self.tag2]],
+                                 [entry.named_tags for entry in entries])
+        
+        def test_batch_select_path_with_same_start(self):
+            sections = Section.objects.batch_select(Batch('entry_set').order_by('id'),
+                                                    'entry_set__tags',
+                                                    'entry_set__tags__entry')\
+                                      .order_by('id')
+            section1 = sections[0]
+            entry1, entry2 = section1.entry_set_all
+            self.failUnlessEqual(set([self.tag1, self.tag3]), set(entry1.tags_all))
+            tag3 = [tag for tag in entry1.tags_all if tag == self.tag3][0]
+            self.failUnlessEqual(set([self.entry1, self.entry2]),
+                                 set(tag3.entry_all))
+        
+        def test_batch_count_path(self):
+            sections = Section.objects.batch_count('entry_set__tags').order_by('id')
+            section1 = sections[0]
+            self.failUnlessEqual([2, 2], [entry.tags_count for entry
+                                          in section1.entry_set_all])
+        
+        def test_batch_select_path_non_existant_field(self):
+            try:
+                Section.objects.batch_select('entry_set__qwerty')
+                self.fail('selected field that does not exist')
+            except FieldDoesNotExist:
+                pass
+
+
+    class TestBatchSelectForeignKey(TransactionTestCase):
+        
+        def setUp(self):
+            super(TestBatchSelectForeignKey, self).setUp()
+            self.section1 = Section.objects.create(name='s1')
+            self.section2 = Section.objects.create(name='s2')
+            self.entry1 = Entry.objects.create(section=self.section1)
+            self.entry2 = Entry.objects.create(section=self.section1)
+            self.entry3 = Entry.objects.create(section=self.section2)
+            self.entry4 = Entry.objects.create()
+            self.review1 = Review.objects.create(entry=self.entry1, rating=3)
+            self.review3 = Review.objects.create(entry=self.entry3, rating=5)
+        
+        @with_debug_queries
+        def test_batch_select_foreign_key(self):
+            db.reset_queries()
+            entry1, entry2, entry3, entry4 = Entry.objects.batch_select('section')\
+                                                          .order_by('id')
+            self.failUnlessEqual(2, len(db.connection.queries))
+            
+            self.failUnlessEqual(self.section1, entry1.section)
+            self.failUnlessEqual(self.section1, entry2.section)
+            self.failUnlessEqual(self.section2, entry3.section)
+            self.failUnlessEqual(None, entry4.section)
+            # the descriptor's cache was filled in, and each section
+            # was only selected once
+            self.failUnlessEqual(2, len(db.connection.queries))
+            self.failUnless(entry1.section is entry2.section)
+        
+        def test_batch_select_foreign_key_named(self):
+            entries = Entry.objects.batch_select(the_section='section').order_by('id')
+            self.failUnlessEqual([self.section1, self.section1, self.section2, None],
+                                 [entry.the_section for entry in entries])
+        
+        def test_batch_select_foreign_key_filtered(self):
+            batch = Batch('section', name='s2')
+            entries = Entry.objects.batch_select(s2=batch).order_by('id')
+            self.failUnlessEqual([None, None, self.section2, None],
+                                 [entry.s2 for entry in entries])
+        
+        def test_batch_select_foreign_key_filtered_default_name(self):
+            batch = Batch('section').filter(name='s2')
+            entry1, entry2, entry3, entry4 = Entry.objects.batch_select(batch)\
+                                                          .order_by('id')
+            self.failUnlessEqual([None, None, self.section2, None],
+                                 [entry1.section_all, entry2.section_all,
+                                  entry3.section_all, entry4.section_all])
+            # the descriptor's cache is left alone
+            self.failUnlessEqual(self.section1, entry1.section)
+            self.failUnlessEqual(self.section2, entry3.section)
+        
+        def test_batch_select_foreign_key_batch_reused(self):
+            batch = Batch('section')
+            entry1 = Entry.objects.batch_select(batch).order_by('id')[0]
+            self.failUnlessEqual(self.section1, entry1.section)
+            entry1 = Entry.objects.batch_select(the_section=batch).order_by('id')[0]
+            self.failUnlessEqual(self.section1, entry1.the_section)
+            self.failUnlessEqual('section_all', batch.target_field_name)
+            
+            entry1, entry2, entry3, entry4 = \
+                Entry.objects.batch_select(batch.filter(name='s2')).order_by('id')
+            self.failUnlessEqual([None, self.section2],
+                                 [entry1.section_all, entry3.section_all])
+            self.failUnlessEqual(self.section1, entry1.section)
+        
+        def test_batch_select_reverse_one_to_one_filtered(self):
+            batch = Batch('review').filter(rating__gte=4)
+            entry1, entry2, entry3, entry4 = Entry.objects.batch_select(batch)\
+                                                          .order_by('id')
+            self.failUnlessEqual(None, entry1.review_all)
+            self.failUnlessEqual(self.review3, entry3.review_all)
+            self.failUnlessEqual(self.review1, entry1.review)
+        
+        def test_batch_select_foreign_key_selected_as_descriptor(self):
+            # the descriptor doesn't use a default manager that filters
+            # (without use_for_related_fields)
+            parent = Highlight.objects.create(
+                note=Note.objects.create(entry=self.entry1), live=False)
+            Highlight.objects.create(note=Note.objects.create(entry=self.entry1),
+                                     parent=parent)
+            highlight = Highlight.objects.batch_select('parent')[0]
+            self.failUnlessEqual(parent, highlight.parent)
+            highlight = Highlight.objects.batch_select(Batch('parent'))[0]
+            self.failUnlessEqual(parent, highlight.parent)
+            # the default manager is still used for other names
+            highlight = Highlight.objects.batch_select(the_parent='parent')[0]
+            self.failUnlessEqual(None, highlight.the_parent)
+        
+        def test_batch_select_reverse_one_to_one_selected_as_descriptor(self):
+            # reverse one-to-one descriptors use the base manager
+            note = Note.objects.create(entry=self.entry1, score=1)
+            highlight = Highlight.objects.create(note=note, live=False)
+            for _ in range(2):
+                # compiled once, then run raw
+                note = Note.objects.batch_select('highlight')[0]
+                self.failUnlessEqual(highlight, note.highlight)
+                note = Note.objects.batch_select(the_highlight='highlight')[0]
+                self.failUnlessEqual(None, note.the_highlight)
+        
+        def test_batch_select_foreign_key_chunked(self):
+            entries = Entry.objects.batch_select(Batch('section').chunk_size(1))\
+                                   .order_by('id')
+            self.failUnlessEqual([self.section1, self.section1, self.section2, None],
+                                 [entry.section for entry in entries])
+        
+        def test_batch_select_foreign_key_values(self):
+            try:
+                list(Entry.objects.batch_select(Batch('section').values('name')))
+                self.fail('selected values for a foreign key')
+            except ValueError:
+                pass
+        
+        @with_debug_queries
+        def test_batch_select_one_to_one(self):
+            db.reset_queries()
+            reviews = Review.objects.batch_select('entry').order_by('id')
+            self.failUnlessEqual([self.entry1, self.entry3],
+                                 [review.entry for review in reviews])
+            self.failUnlessEqual(2, len(db.connection.queries))
+        
+        @with_debug_queries
+        def test_batch_select_reverse_one_to_one(self):
+            db.reset_queries()
+            entry1, entry2, entry3, entry4 = Entry.objects.batch_select('review')\
+                                                          .order_by('id')
+            self.failUnlessEqual(self.review1, entry1.review)
+            self.failUnlessEqual(self.review3, entry3.review)
+            self.failUnlessEqual(2, len(db.connection.queries))
+            try:
+                entry2.review
+                self.fail('entry2 has no review')
+            except Review.DoesNotExist:
+                pass
+            self.failUnlessEqual(2, len(db.connection.queries))
+        
+        def test_batch_select_foreign_key_path(self):
+            entries = Entry.objects.batch_select('section__entry_set').order_by('id')
+            entry1, entry2, entry3, entry4 = entries
+            self.failUnlessEqual(set([self.entry1, self.entry2]),
+                                 set(entry1.section_all.entry_set_all))
+            self.failUnless(entry1.section_all is entry2.section_all)
+            self.failUnlessEqual(None, entry4.section_all)
+    
+    class TestBatchSelectWithThrough(TransactionTestCase):
+        
+        def setUp(self):
+            super(TestBatchSelectWithThrough, self).setUp()
+            self.tag1, self.tag2, self.tag3 = _create_tags('tag1', 'tag2', 'tag3')
+            self.collection1 = Collection.objects.create(name='c1')
+            self.collection2 = Collection.objects.create(name='c2')
+            CollectionTag.objects.create(collection=self.collection1, tag=self.tag1,
+                                         position=2, date_added=date(2010, 1, 2))
+            CollectionTag.objects.create(collection=self.collection1, tag=self.tag2,
+                                         position=1, date_added=date(2010, 1, 1))
+            CollectionTag.objects.create(collection=self.collection2, tag=self.tag1,
+                                         position=1, date_added=date(2010, 1, 3))
+        
+        @with_debug_queries
+        def test_with_through(self):
+            db.reset_queries()
+            batch = Batch('tags').with_through('position', 'date_added').order_by('id')
+            collection1, collection2 = Collection.objects.batch_select(batch)\
+                                                         .order_by('id')
+            self.failUnlessEqual(2, len(db.connection.queries))
+            
+            self.failUnlessEqual([self.tag1, self.tag2], collection1.tags_all)
+            self.failUnlessEqual([(2, date(2010, 1, 2)), (1, date(2010, 1, 1))],
+                                 [(tag.position, tag.date_added)
+                                  for tag in collection1.tags_all])
+            self.failUnlessEqual([(1, date(2010, 1, 3))],
+                                 [(tag.position, tag.date_added)
+                                  for tag in collection2.tags_all])
+        
+        def test_with_through_reverse(self):
+            batch = Batch('collection').with_through('position').order_by('id')
+            tag1, tag2, tag3 = Tag.objects.batch_select(batch).order_by('id')
+            self.failUnlessEqual([(self.collection1, 2), (self.collection2, 1)],
+                                 [(c, c.position) for c in tag1.collection_all])
+            self.failUnlessEqual([], tag3.collection_all)
+        
+        def test_with_through_limit(self):
+            batch = Batch('tags').with_through('position').order_by('-id').limit(1)
+            collection1, collection2 = Collection.objects.batch_select(batch)\
+                                                         .order_by('id')
+            self.failUnlessEqual([(self.tag2, 1)],
+                                 [(tag, tag.position) for tag in collection1.tags_all])
+        
+        def test_with_through_path(self):
+            batch = Batch('collection__tags').with_through('position').order_by('id')
+            tag1 = Tag.objects.batch_select(batch).get(id=self.tag1.id)
+            collection1, collection2 = sorted(tag1.collection_all,
+                                              key=lambda c: c.id)
+            self.failUnlessEqual([(self.tag1, 2), (self.tag2, 1)],
+                                 [(tag, tag.position) for tag in collection1.tags_all])
+            self.failUnlessEqual([(self.tag1, 1)],
+                                 [(tag, tag.position) for tag in collection2.tags_all])
+        
+        def test_with_through_name_taken(self):
+            for name in ('id', 'pk', 'name', 'entry', 'save'):
+                batch = Batch('tags').with_through(name)
+                try:
+                    list(Collection.objects.batch_select(batch))
+                    self.fail('replaced "%s" with a through field' % name)
+                except ValueError:
+                    pass
+        
+        def test_with_through_not_m2m(self):
+            batch = Batch('entry_set').with_through('position')
+            try:
+                list(Section.objects.batch_select(batch))
+                self.fail('selected through fields for a reverse foreign key')
+            except ValueError:
+                pass
+    
+    class TestBatchExecutedSignal(TransactionTestCase):
+        
+        def setUp(self):
+            super(TestBatchExecutedSignal, self).setUp()
+            self.tag1, self.tag2 = _create_tags('tag1', 'tag2')
+            self.entry1, self.entry2, self.entry3 = _create_entries(3)
+            self.entry1.tags.add(self.tag1, self.tag2)
+            self.entry2.tags.add(self.tag1)
+            self.executed = []
+            batch_executed.connect(self._executed, sender=Entry)
+        
+        def tearDown(self):
+            batch_executed.disconnect(self._executed, sender=Entry)
+            super(TestBatchExecutedSignal, self).tearDown()
+        
+        def _executed(self, sender, **kwargs):
+            self.executed.append(kwargs)
+        
+        def test_batch_executed(self):
+            list(Entry.objects.batch_select('tags'))
+            self.failUnlessEqual(1, len(self.executed))
+            executed = self.executed[0]
+            self.failUnlessEqual('tags', executed['relation'])
+            self.failUnlessEqual(3, executed['ids'])
+            self.failUnlessEqual(3, executed['rows'])
+            self.failUnless('batch_select_tag' in executed['sql'])
+            self.failUnless(executed['db_time'] >= 0)
+            self.failUnless(executed['stitch_time'] >= 0)
+            self.failUnlessEqual('default', executed['using'])
+        
+        def test_batch_executed_non_ascii(self):
+            tag = Tag.objects.create(name=u'caf\xe9')
+            self.entry3.tags.add(tag)
+            batch = Batch('tags', name=u'caf\xe9')
+            for _ in range(2):
+                # compiled once, then run raw
+                entry3 = Entry.objects.batch_select(batch).order_by('id')[2]
+                self.failUnlessEqual([tag], entry3.tags_all)
+            self.failUnlessEqual(2, len(self.executed))
+            for executed in self.executed:
+                self.failUnless(u'caf\xe9' in executed['sql'])
+        
+        def test_batch_executed_per_query(self):
+            list(Entry.objects.batch_select(Batch('tags').chunk_size(2))
+                              .batch_count('tags'))
+            self.failUnlessEqual([3, 2, 1],
+                                 sorted([executed['ids'] for executed in self.executed],
+                                        reverse=True))
+        
+        def test_batch_executed_not_sent_for_other_models(self):
+            list(Tag.objects.batch_select('entry'))
+            self.failUnlessEqual([], self.executed)
+        
+        def test_batch_timer_not_listening(self):
+            relation = _resolve_relation(Tag, 'entry')
+            timer = _BatchTimer(Tag, relation, 'default')
+            rows = iter([])
+            self.failUnless(timer.fetch(rows) is rows)
+    
+    class TestBatchSelectSubquery(TransactionTestCase):
+        
+        def setUp(self):
+            super(TestBatchSelectSubquery, self).setUp()
+            self.tag1, self.tag2 = _create_tags('tag1', 'tag2')
+            self.entry1, self.entry2, self.entry3 = _create_entries(3)
+            self.entry1.tags.add(self.tag1, self.tag2)
+            self.entry3.tags.add(self.tag2)
+        
+        def _related_queries(self):
+            return [query['sql'] for query in db.connection.queries[1:]]
+        
+        @with_debug_queries
+        def test_subquery_when_too_many_ids(self):
+            db.reset_queries()
+            batch = Batch('tags').order_by('id')
+            old_chunk_size, DEFAULT_CHUNK_SIZES['sqlite'] = DEFAULT_CHUNK_SIZES['sqlite'], 2
+            try:
+                entry1, entry2, entry3 = Entry.objects.batch_select(batch).order_by('id')
+            finally:
+                DEFAULT_CHUNK_SIZES['sqlite'] = old_chunk_size
+            self.failUnlessEqual([self.tag1, self.tag2], entry1.tags_all)
+            self.failUnlessEqual([], entry2.tags_all)
+            self.failUnlessEqual([self.tag2], entry3.tags_all)
+            
+            queries = self._related_queries()
+            self.failUnlessEqual(1, len(queries))
+            self.failUnless('IN (SELECT' in queries[0])
+        
+        @with_debug_queries
+        def test_subquery_filtered(self):
+            db.reset_queries()
+            batch = Batch('tags').strategy('subquery').order_by('id')
+            entries = Entry.objects.filter(id__in=[self.entry2.id, self.entry3.id])\
+                                   .batch_select(batch).order_by('id')
+            entry2, entry3 = entries
+            self.failUnlessEqual([], entry2.tags_all)
+            self.failUnlessEqual([self.tag2], entry3.tags_all)
+            self.failUnless('IN (SELECT' in self._related_queries()[0])
+        
+        @with_debug_queries
+        def test_ids_strategy(self):
+            db.reset_queries()
+            batch = Batch('tags').chunk_size(1).strategy('ids')
+            list(Entry.objects.batch_select(batch))
+            queries = self._related_queries()
+            self.failUnlessEqual(3, len(queries))
+            self.failIf('IN (SELECT' in queries[0])
+        
+        @with_debug_queries
+        def test_no_subquery_when_sliced(self):
+            db.reset_queries()
+            batch = Batch('tags').strategy('subquery')
+            entry1, entry2 = Entry.objects.batch_select(batch).order_by('id')[:2]
+            self.failUnlessEqual(set([self.tag1, self.tag2]), set(entry1.tags_all))
+            self.failIf('IN (SELECT' in self._related_queries()[0])
+        
+        def test_subquery_path(self):
+            section = Section.objects.create(name='s1')
+            Entry.objects.filter(id__in=[self.entry1.id, self.entry2.id])\
+                         .update(section=section)
+            batch = Batch('entry_set__tags').strategy('subquery')
+            section, = Section.objects.batch_select(batch)
+            self.failUnlessEqual(set([self.entry1, self.entry2]),
+                                 set(section.entry_set_all))
+        
+        def test_unknown_strategy(self):
+            try:
+                Batch('tags').strategy('qwerty')
+                self.fail('used unknown strategy')
+            except ValueError:
+                pass
+    
+    class TestBatchSelectLazy(TransactionTestCase):
+        
+        def setUp(self):
+            super(TestBatchSelectLazy, self).setUp()
+            self.tag1, self.tag2 = _create_tags('tag1', 'tag2')
+            self.entry1, self.entry2, self.entry3 = _create_entries(3)
+            self.entry1.tags.add(self.tag1, self.tag2)
+            self.entry3.tags.add(self.tag2)
+        
+        @with_debug_queries
+        def test_lazy_not_used(self):
+            db.reset_queries()
+            entries = list(Entry.objects.batch_select(Batch('tags').lazy()))
+            self.failUnlessEqual(3, len(entries))
+            self.failUnlessEqual(1, len(db.connection.queries))
+        
+        @with_debug_queries
+        def test_lazy_used(self):
+            db.reset_queries()
+            batch = Batch('tags').lazy().order_by('id')
+            entry1, entry2, entry3 = Entry.objects.batch_select(batch).order_by('id')
+            self.failUnlessEqual(1, len(db.connection.queries))
+            
+            self.failUnlessEqual([self.tag2], list(entry3.tags_all))
+            self.failUnlessEqual(2, len(db.connection.queries))
+            
+            # the other entries' tags were selected at the same time
+            self.failUnlessEqual([self.tag1, self.tag2], entry1.tags_all)
+            self.failUnlessEqual([], entry2.tags_all)
+            self.failUnlessEqual(2, len(entry1.tags_all))
+            self.failUnless(isinstance(entry1.tags_all, list))
+            self.failUnlessEqual(2, len(db.connection.queries))
+        
+        @with_debug_queries
+        def test_lazy_with_other_batches(self):
+            db.reset_queries()
+            entries = Entry.objects.batch_select(lazy_tags=Batch('tags').lazy())\
+                                   .batch_count('tags').order_by('id')
+            entry1, entry2, entry3 = entries
+            self.failUnlessEqual([2, 0, 1], [entry.tags_count for entry in entries])
+            self.failUnlessEqual(2, len(db.connection.queries))
+            self.failUnlessEqual(2, len(entry1.lazy_tags))
+            self.failUnlessEqual(3, len(db.connection.queries))
+        
+        def test_lazy_path_merged(self):
+            section = Section.objects.create(name='s1')
+            Entry.objects.update(section=section)
+            sections = Section.objects.batch_select(Batch('entry_set').lazy(),
+                                                    'entry_set__tags')
+            section, = sections
+            self.failUnless(isinstance(section.entry_set_all, list))
+            self.failUnlessEqual(3, len(section.entry_set_all))
+        
+        def test_lazy_single(self):
+            try:
+                Entry.objects.batch_select(Batch('section').lazy())
+                self.fail('lazily selected a foreign key')
+            except ValueError:
+                pass
+    
+    class TestBatchSelectStream(TransactionTestCase):
+        
+        def setUp(self):
+            super(TestBatchSelectStream, self).setUp()
+            self.tag1, self.tag2, self.tag3 = _create_tags('tag1', 'tag2', 'tag3')
+            self.entry1, self.entry2, self.entry3 = _create_entries(3)
+            self.entry1.tags.add(self.tag1, self.tag2, self.tag3)
+            self.entry3.tags.add(self.tag2, self.tag3)
+        
+        def test_stream(self):
+            batch = Batch('tags').stream()
+            entry1, entry2, entry3 = Entry.objects.batch_select(batch).order_by('id')
+            self.failUnlessEqual(set([self.tag1, self.tag2, self.tag3]),
+                                 set(entry1.tags_all))
+            self.failUnlessEqual([], entry2.tags_all)
+            self.failUnlessEqual(set([self.tag2, self.tag3]), set(entry3.tags_all))
+        
+        @with_debug_queries
+        def test_stream_keeps_ordering(self):
+            db.reset_queries()
+            batch = Batch('tags').order_by('-name').stream()
+            entry1, entry2, entry3 = Entry.objects.batch_select(batch).order_by('id')
+            self.failUnlessEqual([self.tag3, self.tag2, self.tag1], entry1.tags_all)
+            self.failUnlessEqual([self.tag3, self.tag2], entry3.tags_all)
+            self.failUnless('ORDER BY "__entry_id" ASC, "batch_select_tag"."name" DESC'
+                            in db.connection.queries[-1]['sql'])
+        
+        def test_stream_limit(self):
+            batch = Batch('tags').order_by('name').limit(2).stream()
+            entry1, entry2, entry3 = Entry.objects.batch_select(batch).order_by('id')
+            self.failUnlessEqual([self.tag1, self.tag2], entry1.tags_all)
+            self.failUnlessEqual([self.tag2, self.tag3], entry3.tags_all)
+        
+        def test_stream_values_list(self):
+            batch = Batch('tags').order_by('name').values_list('name', flat=True)\
+                                 .stream()
+            entry1, entry2, entry3 = Entry.objects.batch_select(batch).order_by('id')
+            self.failUnlessEqual([u'tag1', u'tag2', u'tag3'], entry1.tags_all)
+            self.failUnlessEqual([u'tag2', u'tag3'], entry3.tags_all)
+    
+    class TestBatchSelectGeneric(TransactionTestCase):
+        
+        def setUp(self):
+            super(TestBatchSelectGeneric, self).setUp()
+            self.entry1, self.entry2 = _create_entries(2)
+            self.section = Section.objects.create(name='s1')
+            self.tag, = _create_tags('tag1')
+            self.comment1 = Comment.objects.create(content_object=self.entry1, text='c1')
+            self.comment2 = Comment.objects.create(content_object=self.section, text='c2')
+            self.comment3 = Comment.objects.create(content_object=self.entry1, text='c3')
+            self.comment4 = Comment.objects.create(content_object=self.tag, text='c4')
+            self.comment5 = Comment.objects.create(text='c5')
+            self.tag.delete()
+        
+        def test_batch_select_generic_relation(self):
+            entry1, entry2 = Entry.objects.batch_select(Batch('comments').order_by('id'))\
+                                          .order_by('id')
+            self.failUnlessEqual([self.comment1, self.comment3], entry1.comments_all)
+            self.failUnlessEqual([], entry2.comments_all)
+        
+        @with_debug_queries
+        def test_batch_select_generic_foreign_key(self):
+            # fill the content type cache
+            ContentType.objects.get_for_models(Entry, Section, Tag)
+            db.reset_queries()
+            comments = Comment.objects.batch_select('content_object').order_by('id')
+            comment1, comment2, comment3, comment4, comment5 = comments
+            # one query for the comments and one per content type
+            self.failUnlessEqual(4, len(db.connection.queries))
+            
+            self.failUnlessEqual(self.entry1, comment1.content_object)
+            self.failUnlessEqual(self.section, comment2.content_object)
+            self.failUnless(comment1.content_object is comment3.content_object)
+            self.failUnlessEqual(None, comment4.content_object)
+            self.failUnlessEqual(None, comment5.content_object)
+            self.failUnlessEqual(4, len(db.connection.queries))
+        
+        def test_batch_select_generic_foreign_key_named(self):
+            batch = Batch('content_object').chunk_size(1)
+            comments = Comment.objects.batch_select(target=batch).order_by('id')
+            self.failUnlessEqual([self.entry1, self.section, self.entry1, None, None],
+                                 [comment.target for comment in comments])
+        
+        def test_batch_select_generic_foreign_key_filtered(self):
+            # filters out everything
+            batch = Batch('content_object').filter(pk=0)
+            comments = Comment.objects.batch_select(batch).order_by('id')
+            comment1, comment2 = comments[:2]
+            self.failUnlessEqual(None, comment1.content_object_all)
+            self.failUnlessEqual(self.entry1, comment1.content_object)
+            self.failUnlessEqual(self.section, comment2.content_object)
+        
+        def test_batch_select_generic_foreign_key_selected_as_descriptor(self):
+            # the descriptor uses the base manager, not a default manager
+            # that filters
+            highlight = Highlight.objects.create(
+                note=Note.objects.create(entry=self.entry1), live=False)
+            Comment.objects.all().delete()
+            Comment.objects.create(content_object=highlight, text='c6')
+            comment = Comment.objects.batch_select('content_object')[0]
+            self.failUnlessEqual(highlight, comment.content_object)
+            comment = Comment.objects.batch_select(target='content_object')[0]
+            self.failUnlessEqual(None, comment.target)
+        
+        def test_batch_select_generic_foreign_key_path(self):
+            try:
+                Comment.objects.batch_select('content_object__tags')
+                self.fail('followed a generic foreign key')
+            except FieldDoesNotExist:
+                pass
+        
+        def test_batch_select_generic_foreign_key_cache(self):
+            try:
+                list(Comment.objects.batch_select(Batch('content_object').cache()))
+                self.fail('cached a generic foreign key')
+            except ValueError:
+                pass
+    
+    class TestBatchLinks(TransactionTestCase):
+        
+        def setUp(self):
+            super(TestBatchLinks, self).setUp()
+            self.tag1, self.tag2, self.tag3 = _create_tags('tag1', 'tag2', 'tag3')
+            self.entry1, self.entry2, self.entry3 = _create_entries(3)
+            self.entry1.tags.add(self.tag1)
+            self.changed = []
+            batch_m2m_changed.connect(self._changed, sender=Entry.tags.through)
+        
+        def tearDown(self):
+            batch_m2m_changed.disconnect(self._changed, sender=Entry.tags.through)
+            super(TestBatchLinks, self).tearDown()
+        
+        def _changed(self, sender, action, links, **kwargs):
+            self.changed.append((action, links))
+        
+        def _tags(self, entry):
+            return set(entry.tags.all())
+        
+        @with_debug_queries
+        def test_batch_add(self):
+            db.reset_queries()
+            added = Entry.objects.batch_add('tags', {
+                self.entry1: [self.tag1, self.tag2],
+                self.entry2.pk: [self.tag2.pk, self.tag3.pk],
+            }, send_m2m_changed=False)
+            self.failUnlessEqual(3, added)
+            # one query for the existing links and one insert
+            queries = [query['sql'] for query in db.connection.queries
+                       if 'BEGIN' not in query['sql']]
+            self.failUnlessEqual(2, len(queries))
+            
+            self.failUnlessEqual(set([self.tag1, self.tag2]), self._tags(self.entry1))
+            self.failUnlessEqual(set([self.tag2, self.tag3]), self._tags(self.entry2))
+            self.failUnlessEqual(set(), self._tags(self.entry3))
+            
+            links = {self.entry1.pk: set([self.tag2.pk]),
+                     self.entry2.pk: set([self.tag2.pk, self.tag3.pk])}
+            self.failUnlessEqual([('pre_add', links), ('post_add', links)],
+                                 self.changed)
+        
+        def test_batch_add_reverse(self):
+            added = Tag.objects.batch_add('entry', {self.tag2: [self.entry1, self.entry2]})
+            self.failUnlessEqual(2, added)
+            self.failUnlessEqual(set([self.tag1, self.tag2]), self._tags(self.entry1))
+            self.failUnlessEqual(set([self.tag2]), self._tags(self.entry2))
+        
+        def test_batch_add_nothing_new(self):
+            self.failUnlessEqual(0, Entry.objects.batch_add('tags', {self.entry1: [self.tag1]},
+                                                            send_m2m_changed=False))
+            self.failUnlessEqual([], self.changed)
+        
+        def test_batch_remove(self):
+            self.entry2.tags.add(self.tag2)
+            removed = Entry.objects.batch_remove('tags', {
+                self.entry1: [self.tag1, self.tag2],
+                self.entry2: [self.tag2],
+            }, send_m2m_changed=False)
+            self.failUnlessEqual(2, removed)
+            self.failUnlessEqual(set(), self._tags(self.entry1))
+            self.failUnlessEqual(set(), self._tags(self.entry2))
+            self.failUnlessEqual(['pre_remove', 'post_remove'],
+                                 [action for action, _ in self.changed])
+        
+        def test_batch_set(self):
+            self.entry2.tags.add(self.tag2)
+            changed = Entry.objects.batch_set('tags', {
+                self.entry1: [self.tag2, self.tag3],
+                self.entry2: [self.tag2],
+                self.entry3: [],
+            })
+            self.failUnlessEqual((2, 1), changed)
+            self.failUnlessEqual(set([self.tag2, self.tag3]), self._tags(self.entry1))
+            self.failUnlessEqual(set([self.tag2]), self._tags(self.entry2))
+            self.failUnlessEqual(set(), self._tags(self.entry3))
+        
+        def test_batch_add_m2m_changed(self):
+            changed = []
+            def _m2m_changed(sender, instance, action, reverse, model, pk_set,
+                             using, **kwargs):
+                changed.append((action, instance, reverse, model, pk_set, using))
+            m2m_changed.connect(_m2m_changed, sender=Entry.tags.through)
+            try:
+                Entry.objects.batch_add('tags', {
+                    self.entry1: [self.tag1, self.tag2],
+                    self.entry2.pk: [self.tag3.pk],
+                })
+            finally:
+                m2m_changed.disconnect(_m2m_changed, sender=Entry.tags.through)
+            self.failUnlessEqual(set([
+                    ('pre_add', self.entry1, False, Tag, frozenset([self.tag2.pk]), 'default'),
+                    ('pre_add', self.entry2, False, Tag, frozenset([self.tag3.pk]), 'default'),
+                    ('post_add', self.entry1, False, Tag, frozenset([self.tag2.pk]), 'default'),
+                    ('post_add', self.entry2, False, Tag, frozenset([self.tag3.pk]), 'default'),
+                ]), set((action, instance, reverse, model, frozenset(pk_set), using)
+                        for action, instance, reverse, model, pk_set, using in changed))
+            self.failUnlessEqual(['pre_add', 'pre_add', 'post_add', 'post_add'],
+                                 [action for action, _, _, _, _, _ in changed])
+            # the batched signal is only sent when asked for
+            self.failUnlessEqual([], self.changed)
+        
+        def test_batch_remove_m2m_changed_reverse(self):
+            changed = []
+            def _m2m_changed(sender, instance, action, reverse, model, pk_set,
+                             **kwargs):
+                changed.append((action, instance, reverse, model, pk_set))
+            m2m_changed.connect(_m2m_changed, sender=Entry.tags.through)
+            try:
+                Tag.objects.batch_remove('entry', {self.tag1: [self.entry1]})
+            finally:
+                m2m_changed.disconnect(_m2m_changed, sender=Entry.tags.through)
+            self.failUnlessEqual([('pre_remove', self.tag1, True, Entry,
+                                   set([self.entry1.pk])),
+                                  ('post_remove', self.tag1, True, Entry,
+                                   set([self.entry1.pk]))], changed)
+        
+        def test_batch_add_invalidates_cache(self):
+            batch_cache.cache.clear()
+            list(Entry.objects.batch_select(Batch('tags').cache()))
+            Entry.objects.batch_add('tags', {self.entry2: [self.tag3]})
+            entry1, entry2, entry3 = Entry.objects.batch_select(Batch('tags').cache())\
+                                                  .order_by('id')
+            self.failUnlessEqual([self.tag3], entry2.tags_all)
+        
+        def test_batch_add_not_m2m(self):
+            try:
+                Section.objects.batch_add('entry', {})
+                self.fail('added links to a reverse foreign key')
+            except ValueError:
+                pass
+        
+        def test_batch_add_custom_through(self):
+            collection = Collection.objects.create(name='c1')
+            try:
+                Collection.objects.batch_add('tags', {collection: [self.tag1]})
+                self.fail('added links with a custom through model')
+            except ValueError:
+                pass
+    
+    class TestBatchSelectRaw(TransactionTestCase):
+        
+        def setUp(self):
+            super(TestBatchSelectRaw, self).setUp()
+            _raw_query_cache.clear()
+            self.section = Section.objects.create(name='s1')
+            self.tag1, self.tag2, self.tag3 = _create_tags('tag1', 'tag2', 'tag3')
+            self.entry1, self.entry2, self.entry3 = _create_entries(3)
+            for entry in (self.entry1, self.entry3):
+                entry.section = self.section
+                entry.save()
+            self.entry1.tags.add(self.tag1, self.tag2, self.tag3)
+            self.entry3.tags.add(self.tag2)
+            Comment.objects.create(content_object=self.entry2, text='c1')
+            Comment.objects.create(content_object=self.entry2, text='c2')
+        
+        def _select(self, queryset, *batches, **kwargs):
+            old_raw = getattr(settings, 'BATCH_SELECT_RAW_QUERIES', True)
+            settings.BATCH_SELECT_RAW_QUERIES = kwargs.get('raw', True)
+            try:
+                return list(queryset.batch_select(*batches).order_by('id'))
+            finally:
+                settings.BATCH_SELECT_RAW_QUERIES = old_raw
+        
+        def _related(self, instances, target_field_name):
+            return [[(related, related.__dict__.copy(), related._state.db,
+                      related._state.adding)
+                     for related in getattr(instance, target_field_name)]
+                    for instance in instances]
+        
+        def _check_same(self, queryset, batch, target_field_name):
+            raw = self._select(queryset, batch)
+            orm = self._select(queryset, batch, raw=False)
+            raw_related = self._related(raw, target_field_name)
+            orm_related = self._related(orm, target_field_name)
+            for groups in (raw_related, orm_related):
+                for group in groups:
+                    for related, attrs, _, _ in group:
+                        del attrs['_state']
+            self.failUnlessEqual(orm_related, raw_related)
+            return raw
+        
+        def test_raw_m2m(self):
+            entries = self._check_same(Entry.objects.all(), 'tags', 'tags_all')
+            self.failUnlessEqual([self.tag1, self.tag2, self.tag3],
+                                 sorted(entries[0].tags_all, key=lambda tag: tag.id))
+            self.failUnlessEqual(1, len(_raw_query_cache))
+        
+        def test_raw_reverse_foreign_key(self):
+            self._check_same(Section.objects.all(), 'entry_set', 'entry_set_all')
+        
+        def test_raw_generic(self):
+            entries = self._check_same(Entry.objects.all(), 'comments',
+                                       'comments_all')
+            self.failUnlessEqual([u'c1', u'c2'],
+                                 sorted(comment.text for comment in
+                                        entries[1].comments_all))
+        
+        @with_debug_queries
+        def test_raw_chunked(self):
+            db.reset_queries()
+            entries = self._select(Entry.objects.all(), Batch('tags').chunk_size(2))
+            self.failUnlessEqual(3, len(db.connection.queries))
+            self.failUnless('IN (%s, %s)' in db.connection.queries[1]['sql'])
+            self.failUnless('IN (%s)' in db.connection.queries[2]['sql'])
+            self.failUnlessEqual(set([self.tag1, self.tag2, self.tag3]),
+                                 set(entries[0].tags_all))
+            self.failUnlessEqual([self.tag2], entries[2].tags_all)
+        
+        def test_raw_not_used_with_replays(self):
+            entries = self._select(Entry.objects.all(),
+                                   Batch('tags').order_by('-name'))
+            self.failUnlessEqual([self.tag3, self.tag2, self.tag1],
+                                 entries[0].tags_all)
+            self.failUnlessEqual({}, _raw_query_cache)
+        
+        def test_compiled_replays(self):
+            batch = Batch('tags', name__in=['tag1', 'tag2']).order_by('-name')
+            entries = self._check_same(Entry.objects.all(), batch, 'tags_all')
+            self.failUnlessEqual([self.tag2, self.tag1], entries[0].tags_all)
+            self.failUnlessEqual([self.tag2], entries[2].tags_all)
+            self.failUnlessEqual(1, len(batch._compiled_queries))
+            self.failIf(None in batch._compiled_queries.values())
+        
+        def test_compiled_replays_reused(self):
+            batch = Batch('tags').order_by('-name')
+            replayed = []
+            replay = batch.replay
+            def _replay(target):
+                replayed.append(target)
+                return replay(target)
+            batch.replay = _replay
+            self._select(Entry.objects.all(), batch)
+            self.failUnlessEqual(1, len(replayed))
+            entries = self._select(Entry.objects.filter(id=self.entry3.id), batch)
+            self.failUnlessEqual(1, len(replayed))
+            self.failUnlessEqual([self.tag2], entries[0].tags_all)
+        
+        def test_compiled_replays_shared_by_options(self):
+            batch = Batch('tags').order_by('-name')
+            self.failUnless(batch.chunk_size(2)._compiled_queries is
+                            batch._compiled_queries)
+            self.failIf(batch.filter(name='tag1')._compiled_queries is
+                        batch._compiled_queries)
+        
+        def test_callable_replays_not_compiled(self):
+            batch = Batch('tags', name=lambda: 'tag2')
+            entries = self._select(Entry.objects.all(), batch)
+            self.failUnlessEqual([self.tag2], entries[0].tags_all)
+            self.failUnlessEqual({}, batch._compiled_queries)
+        
+        def test_raw_manager_filtering_at_run_time(self):
+            Note.objects.create(entry=self.entry1, score=1)
+            note5 = Note.objects.create(entry=self.entry1, score=5)
+            self._select(Entry.objects.all(), 'note_set')
+            NOTE_FILTER['min_score'] = 3
+            try:
+                entries = self._select(Entry.objects.all(), 'note_set')
+                self.failUnlessEqual([note5], entries[0].note_set_all)
+                self.failUnlessEqual(list(self.entry1.note_set.all()),
+                                     entries[0].note_set_all)
+            finally:
+                NOTE_FILTER['min_score'] = 0
+        
+        def test_compiled_replays_manager_filtering_at_run_time(self):
+            note1 = Note.objects.create(entry=self.entry1, score=1)
+            note5 = Note.objects.create(entry=self.entry1, score=5)
+            batch = Batch('note_set').order_by('-score')
+            entries = self._select(Entry.objects.all(), batch)
+            self.failUnlessEqual([note5, note1], entries[0].note_set_all)
+            NOTE_FILTER['min_score'] = 3
+            try:
+                entries = self._select(Entry.objects.all(), batch)
+                self.failUnlessEqual([note5], entries[0].note_set_all)
+            finally:
+                NOTE_FILTER['min_score'] = 0
+            entries = self._select(Entry.objects.all(), batch)
+            self.failUnlessEqual([note5, note1], entries[0].note_set_all)
+        
+        def test_raw_disabled(self):
+            self._select(Entry.objects.all(), 'tags', raw=False)
+            self.failUnlessEqual({}, _raw_query_cache)
+    
     class ReplayTestCase(unittest.TestCase):
         
         def setUp(self):
@@ -0,0 +1,35 @@
+'''
+Models used by the benchmarks - the same shape as the models in the tests,
+plus generic comments.
+'''
+from django.db import models
+from django.contrib.contenttypes import generic
+from django.contrib.contenttypes.models import ContentType
+
+from batch_select.models import BatchManager
+
+class Tag(models.Model):
+    name = models.CharField(max_length=32)
+    
+    objects = BatchManager()
+
+class Section(models.Model):
+    name = models.CharField(max_length=32)
+    
+    objects = BatchManager()
+
+class Comment(models.Model):
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.PositiveIntegerField()
+    content_object = generic.GenericForeignKey()
+    text = models.CharField(max_length=255)
+    
+    objects = BatchManager()
+
+class Entry(models.Model):
+    title = models.CharField(max_length=255)
+    section = models.ForeignKey(Section, blank=True, null=True)
+    tags = models.ManyToManyField(Tag)
+    comments = generic.GenericRelation(Comment)
+    
+    objects = BatchManager()
@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+'''
+Benchmarks batch_select against prefetch_related and plain (n+1) access
+to related objects, on sqlite.
+
+e.g. run from the parent directory:
+
+    python benchmarks/run.py --sizes 100,1000,10000 --output results.json
+    python benchmarks/run.py --sizes 100,1000,10000 --compare results.json
+
+For each scenario (relation), strategy and number of parent objects this
+reports the wall time, number of queries, rows read from the database and
+peak memory used.  Each measurement is run in its own process, so that the
+peak memory of one doesn't hide that of another.  The databases are built
+once (per size and fan-out) and kept in --data-dir between runs.
+'''
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCHMARKS_DIR)
+
+DEFAULT_SIZES = (100, 1000, 10000)
+DEFAULT_FANOUT = 5
+DEFAULT_REPEAT = 3
+DEFAULT_DATA_DIR = os.path.join(tempfile.gettempdir(),
+                                'django-batch-select-benchmarks')
+
+# number of distinct tags the entries' tags are picked from
+TAG_COUNT = 1000
+# rows inserted per query when building the databases
+INSERT_BATCH_SIZE = 500
+
+# scenario -> (parent model name, relation)
+SCENARIOS = {
+    'm2m': ('Entry', 'tags'),
+    'reverse_fk': ('Section', 'entry_set'),
+    'generic': ('Entry', 'comments'),
+}
+STRATEGIES = ('batch_select', 'batch_select_orm', 'prefetch_related', 'naive')
+
+def _setup_django(db_path):
+    sys.path[:0] = [ROOT_DIR, BENCHMARKS_DIR]
+    from django.conf import settings
+    settings.configure(
+        DATABASES={
+            'default': {
+                'ENGINE': 'django.db.backends.sqlite3',
+                'NAME': db_path,
+            },
+        },
+        INSTALLED_APPS=('django.contrib.contenttypes', 'bench_app'),
+        SECRET_KEY='benchmarks',
+    )
+
+def _db_path(data_dir, size, fanout):
+    return os.path.join(data_dir, 'bench-%d-%d.sqlite3' % (size, fanout))
+
+def _build(size, fanout):
+    # sections each with fanout entries (for reverse_fk), the first size
+    # entries having fanout tags (for m2m) and comments (for generic)
+    from django.core.management import call_command
+    from django.db import transaction
+    from django.contrib.contenttypes.models import ContentType
+    from bench_app.models import Tag, Section, Entry, Comment
+
+    call_command('syncdb', interactive=False, verbosity=0)
+    rand = random.Random(0)
+    with transaction.atomic():
+        Tag.objects.bulk_create([Tag(name='tag%d' % i) for i in xrange(TAG_COUNT)],
+                                batch_size=INSERT_BATCH_SIZE)
+        Section.objects.bulk_create([Section(name='section%d' % i)
+                                     for i in xrange(size)],
+                                    batch_size=INSERT_BATCH_SIZE)
+        section_ids = list(Section.objects.values_list('id', flat=True))
+        Entry.objects.bulk_create([Entry(title='entry', section_id=section_id)
+                                   for section_id in section_ids
+                                   for _ in xrange(fanout)],
+                                  batch_size=INSERT_BATCH_SIZE)
+        entry_ids = list(Entry.objects.order_by('id')
+                                      .values_list('id', flat=True)[:size])
+
+        tag_ids = list(Tag.objects.values_list('id', flat=True))
+        Through = Entry.tags.through
+        Through.objects.bulk_create([Through(entry_id=entry_id, tag_id=tag_id)
+                                     for entry_id in entry_ids
+                                     for tag_id in rand.sample(tag_ids, fanout)],
+                                    batch_size=INSERT_BATCH_SIZE)
+
+        content_type = ContentType.objects.get_for_model(Entry)
+        Comment.objects.bulk_create([Comment(content_type=content_type,
+                                             object_id=entry_id,
+                                             text='comment')
+                                     for entry_id in entry_ids
+                                     for _ in xrange(fanout)],
+                                    batch_size=INSERT_BATCH_SIZE)
+
+def _batch_select(queryset, relation):
+    for parent in queryset.batch_select(relation):
+        yield getattr(parent, '%s_all' % relation)
+
+def _batch_select_orm(queryset, relation):
+    # without reading plain batches with raw queries, for comparison
+    from django.conf import settings
+    settings.BATCH_SELECT_RAW_QUERIES = False
+    return _batch_select(queryset, relation)
+
+def _prefetch_related(queryset, relation):
+    for parent in queryset.prefetch_related(relation):
+        yield list(getattr(parent, relation).all())
+
+def _naive(queryset, relation):
+    for parent in queryset:
+        yield list(getattr(parent, relation).all())
+
+def _count_queries(connection, stats):
+    # count the queries run and rows read through the connection
+    from django.db.backends.util import CursorWrapper
+
+    class CountingCursorWrapper(CursorWrapper):
+        def execute(self, sql, params=None):
+            stats['queries'] += 1
+            return super(CountingCursorWrapper, self).execute(sql, params)
+
+        def executemany(self, sql, param_list):
+            stats['queries'] += 1
+            return super(CountingCursorWrapper, self).executemany(sql, param_list)
+
+        def fetchone(self):
+            row = self.cursor.fetchone()
+            if row is not None:
+                stats['rows'] += 1
+            return row
+
+        def fetchmany(self, *args):
+            rows = self.cursor.fetchmany(*args)
+            stats['rows'] += len(rows)
+            return rows
+
+        def fetchall(self):
+            rows = self.cursor.fetchall()
+            stats['rows'] += len(rows)
+            return rows
+
+        def __iter__(self):
+            for row in self.cursor:
+                stats['rows'] += 1
+                yield row
+
+    connection.use_debug_cursor = True
+    connection.make_debug_cursor = lambda cursor: CountingCursorWrapper(cursor, connection)
+
+def _measure(scenario, strategy, size):
+    from django.db import connection
+    from bench_app import models
+
+    model_name, relation = SCENARIOS[scenario]
+    model = getattr(models, model_name)
+    fetch = globals()['_%s' % strategy]
+
+    queryset = model.objects.order_by('id')[:size]
+    # open the connection (and fill the content type cache) beforehand
+    list(model.objects.all()[:1])
+    models.ContentType.objects.get_for_model(models.Entry)
+
+    result = {
+        'scenario': scenario,
+        'strategy': strategy,
+        'size': size,
+    }
+    stats = {'queries': 0, 'rows': 0}
+    _count_queries(connection, stats)
+    gc.collect()
+    start_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    try:
+        related = sum(len(related) for related in fetch(queryset, relation))
+    except Exception, e:
+        # record strategies that don't work (yet), rather than stopping
+        result['error'] = '%s: %s' % (e.__class__.__name__, e)
+        return result
+    wall_time = time.time() - start
+    peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start_memory
+    if sys.platform == 'darwin':
+        peak_memory //= 1024 # bytes rather than kilobytes
+
+    result.update({
+        'wall_time': wall_time,
+        'queries': stats['queries'],
+        'rows': stats['rows'],
+        'related': related,
+        'peak_memory_kb': peak_memory,
+    })
+    return result
+
+def _run_child(*args):
+    return subprocess.check_output([sys.executable, os.path.abspath(__file__)] +
+                                   [str(arg) for arg in args])
+
+def _run_measurement(db_path, scenario, strategy, size, repeat):
+    # best time (and memory) of repeat runs, each in a new process
+    runs = [json.loads(_run_child('--measure', db_path, scenario, strategy, size))
+            for _ in xrange(repeat)]
+    if 'error' in runs[0]:
+        return runs[0]
+    result = min(runs, key=lambda run: run['wall_time'])
+    result['peak_memory_kb'] = min(run['peak_memory_kb'] for run in runs)
+    return result
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       cwd=ROOT_DIR,
+                                       stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def _result_key(result):
+    return (result['scenario'], result['strategy'], result['size'])
+
+def _print_result(result, previous=None):
+    if 'error' in result:
+        print '%-10s %-16s %8d  failed: %s' % (result['scenario'],
+                result['strategy'], result['size'], result['error'])
+        return
+    line = '%-10s %-16s %8d %9.3fs %7d queries %9d rows %8d KB' % (
+                result['scenario'], result['strategy'], result['size'],
+                result['wall_time'], result['queries'], result['rows'],
+                result['peak_memory_kb'])
+    if previous is not None and previous.get('wall_time'):
+        line += '  (%.2fx time, %+d queries)' % (
+                    result['wall_time'] / previous['wall_time'],
+                    result['queries'] - previous['queries'])
+    print line
+    sys.stdout.flush()
+
+def _split(value, type=str):
+    return [type(item) for item in value.split(',') if item]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=lambda value: _split(value, int),
+                        default=list(DEFAULT_SIZES),
+                        help='comma separated numbers of parent objects '
+                             '(default %(default)s)')
+    parser.add_argument('--fanout', type=int, default=DEFAULT_FANOUT,
+                        help='related objects per parent (default %(default)s)')
+    parser.add_argument('--scenarios', type=_split, default=sorted(SCENARIOS),
+                        help='comma separated scenarios (default %(default)s)')
+    parser.add_argument('--strategies', type=_split, default=list(STRATEGIES),
+                        help='comma separated strategies (default %(default)s)')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT,
+                        help='runs of each measurement, the best being kept '
+                             '(default %(default)s)')
+    parser.add_argument('--data-dir', default=DEFAULT_DATA_DIR,
+                        help='where the databases are kept (default %(default)s)')
+    parser.add_argument('--rebuild', action='store_true',
+                        help='rebuild the databases, even if they exist')
+    parser.add_argument('--output', help='save the results to this JSON file')
+    parser.add_argument('--compare', help='compare with results saved earlier')
+    # used when running the benchmarks in child processes
+    parser.add_argument('--build', nargs=3, help=argparse.SUPPRESS)
+    parser.add_argument('--measure', nargs=4, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.build:
+        db_path, size, fanout = args.build
+        _setup_django(db_path)
+        _build(int(size), int(fanout))
+        return
+    if args.measure:
+        db_path, scenario, strategy, size = args.measure
+        _setup_django(db_path)
+        print json.dumps(_measure(scenario, strategy, int(size)))
+        return
+
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error('unknown scenario %r' % name)
+    for name in args.strategies:
+        if name not in STRATEGIES:
+            parser.error('unknown strategy %r' % name)
+
+    previous = {}
+    if args.compare:
+        with open(args.compare) as f:
+            previous = dict((_result_key(result), result)
+                            for result in json.load(f)['results']
+                            if result.get('fanout', args.fanout) == args.fanout)
+
+    if not os.path.isdir(args.data_dir):
+        os.makedirs(args.data_dir)
+
+    results = []
+    for size in args.sizes:
+        db_path = _db_path(args.data_dir, size, args.fanout)
+        if args.rebuild and os.path.exists(db_path):
+            os.remove(db_path)
+        if not os.path.exists(db_path):
+            print 'building database for %d parents...' % size
+            sys.stdout.flush()
+            _run_child('--build', db_path, size, args.fanout)
+        for scenario in args.scenarios:
+            for strategy in args.strategies:
+                result = _run_measurement(db_path, scenario, strategy, size,
+                                          args.repeat)
+                result['fanout'] = args.fanout
+                results.append(result)
+                _print_result(result, previous.get(_result_key(result)))
+
+    if args.output:
+        import django
+        with open(args.output, 'w') as f:
+            json.dump({
+                'commit': _git_commit(),
+                'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
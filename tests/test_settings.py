@@ -11,9 +11,13 @@ DATABASES = {
         'NAME': DATABASE_NAME,
         'ENGINE': 'django.db.backends.sqlite3',
     },
+    'other': {
+        'NAME': DATABASE_NAME,
+        'ENGINE': 'django.db.backends.sqlite3',
+    },
 }
 
-INSTALLED_APPS = ( 'batch_select', )
+INSTALLED_APPS = ( 'django.contrib.contenttypes', 'batch_select', )
 
 
 TESTING_BATCH_SELECT=True